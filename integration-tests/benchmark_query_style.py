@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import gc
+import os
+import sys
+import time
+from optparse import OptionParser
+from pathlib import Path
+
+# Add `src` directory to the import paths
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import libkomwm
+import mapcss
+from mapcss.StyleChooser import StyleCascade
+
+
+class CountingCascade(StyleCascade):
+    """
+    StyleCascade which counts style dicts it copies
+    """
+    copies = 0
+
+    def own(self, i):
+        if not self.owned[i]:
+            CountingCascade.copies += 1
+        return StyleCascade.own(self, i)
+
+    def append(self, style, object_id, owned):
+        if owned:
+            # A copy of "::*" style
+            CountingCascade.copies += 1
+        StyleCascade.append(self, style, object_id, owned)
+
+
+class CopyingCascade(CountingCascade):
+    """
+    StyleCascade which copies every added style like
+    StyleChooser.applyStyles() did before the cascade kept shared styles
+    """
+
+    def add(self, style, object_id):
+        style = style.copy()
+        CountingCascade.copies += 1
+        count = len(self.styles)
+        CountingCascade.add(self, style, object_id)
+        # New subparts are the copy already
+        for i in range(count, len(self.styles)):
+            if not self.owned[i]:
+                self.styles[i]["object-id"] = self.object_ids[i]
+                self.owned[i] = True
+
+
+def copying_get_style_dict(style, clname, type, tags={}, zoom=0, xscale=1, zscale=.5, olddict={}, filter_by_runtime_conditions=None):
+    """
+    MapCSS.get_style_dict() which copies styles made by get_style() into
+    `olddict` like it did before
+    """
+    for x in style.get_style(clname, type, tags, zoom, xscale, zscale, filter_by_runtime_conditions):
+        object_id = x.get('object-id', '')
+        if object_id not in olddict:
+            olddict[object_id] = {}
+            CountingCascade.copies += 1
+        olddict[object_id].update(x)
+    return olddict
+
+
+def use_path(style, copying):
+    """
+    Makes libkomwm.query_style() get styles in the current way or in the
+    copying one, both count copies of style dicts
+    """
+    if copying:
+        # MapCSS.get_style() makes cascades of this class
+        mapcss.StyleCascade = CopyingCascade
+        style.get_style_dict = lambda *args, **kwargs: copying_get_style_dict(style, *args, **kwargs)
+    else:
+        mapcss.StyleCascade = CountingCascade
+        style.__dict__.pop('get_style_dict', None)
+
+
+def query_all(classes, minzoom, maxzoom):
+    """
+    Queries styles of the classes like libkomwm.komap_mapswithme() does
+    """
+    for cl, tags in classes:
+        libkomwm.query_style((cl, dict(tags), minzoom, maxzoom))
+
+
+def measure_time(classes, minzoom, maxzoom, repeat):
+    """
+    Returns the best time of querying all the classes
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        query_all(classes, minzoom, maxzoom)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-d", "--data-path", dest="data",
+                      help="path to mapcss-mapping.csv and other files", metavar="PATH")
+    parser.add_option("-s", "--style", dest="filename",
+                      help="stylesheet to load, default is styles/default/light/style.mapcss of the data path", metavar="FILE")
+    parser.add_option("-f", "--minzoom", dest="minzoom", default=0, type="int",
+                      help="minimal available zoom level", metavar="ZOOM")
+    parser.add_option("-t", "--maxzoom", dest="maxzoom", default=20, type="int",
+                      help="maximal available zoom level", metavar="ZOOM")
+    parser.add_option("-r", "--repeat", dest="repeat", default=5, type="int",
+                      help="number of timed runs, the best one is reported", metavar="N")
+
+    (options, args) = parser.parse_args()
+
+    if options.data is None:
+        parser.error("Please specify base 'data' path.")
+    if options.filename is None:
+        options.filename = os.path.join(options.data, 'styles/default/light/style.mapcss')
+
+    classificator, class_order, class_tree = libkomwm.load_classificator(options.data)
+    style = libkomwm.style = libkomwm.load_style(options, options.data, classificator, class_order)
+    classes = [(cl, classificator[cl]) for cl in class_order]
+    calls = len(classes)
+
+    print(f"Style: {options.filename}")
+    print(f"query_style() calls: {calls}, zooms {options.minzoom}-{options.maxzoom}")
+    # Both paths query the same style
+    for name, copying in (("StyleCascade", False), ("Copying", True)):
+        use_path(style, copying)
+        # The first run fills caches of the style
+        query_all(classes, options.minzoom, options.maxzoom)
+        CountingCascade.copies = 0
+        query_all(classes, options.minzoom, options.maxzoom)
+        copies = CountingCascade.copies
+        gc.collect()
+        elapsed = measure_time(classes, options.minzoom, options.maxzoom, options.repeat)
+        print(f"{name} path: {elapsed:.3f} s, {elapsed * 1000000 / calls:.0f} us per call, "
+              f"{copies / calls:.0f} style dicts copied per call")
+    use_path(style, False)
+    mapcss.StyleCascade = StyleCascade
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ import logging
 sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
 
 import libkomwm
+from mapcss import ParseUnitCache
 
 FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
 logging.basicConfig(format=FORMAT)
@@ -29,6 +30,8 @@ styles = {
 def full_styles_regenerate(options):
     log.info("Start generating styles")
     libkomwm.MULTIPROCESSING = False
+    # Themes import the same files, tokenize each of them once
+    libkomwm.PARSE_UNIT_CACHE = ParseUnitCache()
     prio_ranges_orig = deepcopy(libkomwm.prio_ranges)
 
     for name, (style_path, include_path) in styles.items():
@@ -58,6 +61,10 @@ def main():
                       help="maximal available zoom level", metavar="ZOOM")
     parser.add_option("-x", "--txt", dest="txt", action="store_true",
                       help="create a text file for output", default=False)
+    parser.add_option("-c", "--cache-dir", dest="cache_dir",
+                      help="cache parsed stylesheets in DIR to skip parsing of unchanged styles", metavar="DIR")
+    parser.add_option("-j", "--parse-processes", dest="parse_processes", type="int",
+                      help="tokenize imported stylesheets in N processes", metavar="N")
 
     (options, args) = parser.parse_args()
 
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import gc
+import os
+import sys
+import tracemalloc
+from multiprocessing import get_context
+from optparse import OptionParser
+from pathlib import Path
+
+# Add `src` directory to the import paths
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import libkomwm
+from mapcss.Condition import Condition
+from mapcss.Rule import Rule
+from mapcss.StyleChooser import StyleChooser
+
+# Style loaded by the parent process, workers inherit it with fork
+style = None
+
+
+def object_sizes(classes):
+    """
+    Returns class -> (count, bytes) of live objects of the classes, instance dicts included
+    """
+    sizes = dict((cls, [0, 0]) for cls in classes)
+    for obj in gc.get_objects():
+        size = sizes.get(type(obj))
+        if size is not None:
+            size[0] += 1
+            size[1] += sys.getsizeof(obj)
+            if hasattr(obj, '__dict__'):
+                size[1] += sys.getsizeof(obj.__dict__)
+    return sizes
+
+
+def process_memory():
+    """
+    Returns dict of memory counters of this process in kB: rss, shared and private
+    """
+    memory = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                if name in ('Rss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty'):
+                    memory[name] = int(value.split()[0])
+    except IOError:
+        # Not Linux, only RSS is known
+        import resource
+        return {'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    return {'rss': memory['Rss'],
+            'shared': memory['Shared_Clean'] + memory['Shared_Dirty'],
+            'private': memory['Private_Clean'] + memory['Private_Dirty']}
+
+
+def query_classes(args):
+    """
+    Queries styles of the classes on all zooms like libkomwm.query_style()
+    does and returns memory counters of the worker
+    """
+    classes, minzoom, maxzoom = args
+    for cl, tags in classes:
+        clname = cl if cl.find('-') == -1 else cl[:cl.find('-')]
+        for zoom in range(minzoom, maxzoom + 1):
+            for ftype in ("line", "area", "node"):
+                style.get_style_dict(clname, ftype, dict(tags), zoom, olddict={})
+    return os.getpid(), process_memory()
+
+
+def main():
+    global style
+
+    parser = OptionParser()
+    parser.add_option("-d", "--data-path", dest="data",
+                      help="path to mapcss-mapping.csv and other files", metavar="PATH")
+    parser.add_option("-s", "--style", dest="filename",
+                      help="stylesheet to load, default is styles/default/light/style.mapcss of the data path", metavar="FILE")
+    parser.add_option("-f", "--minzoom", dest="minzoom", default=0, type="int",
+                      help="minimal available zoom level", metavar="ZOOM")
+    parser.add_option("-t", "--maxzoom", dest="maxzoom", default=20, type="int",
+                      help="maximal available zoom level", metavar="ZOOM")
+    parser.add_option("-j", "--processes", dest="processes", default=4, type="int",
+                      help="number of forked workers", metavar="N")
+
+    (options, args) = parser.parse_args()
+
+    if options.data is None:
+        parser.error("Please specify base 'data' path.")
+    if options.filename is None:
+        options.filename = os.path.join(options.data, 'styles/default/light/style.mapcss')
+
+    classificator, class_order, class_tree = libkomwm.load_classificator(options.data)
+
+    gc.collect()
+    memory_before = process_memory()
+    tracemalloc.start()
+    style = libkomwm.load_style(options, options.data, classificator, class_order)
+    gc.collect()
+    traced, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    memory_loaded = process_memory()
+
+    print(f"Style: {options.filename}")
+    print(f"Allocated by style: {traced // 1024} kB (peak {traced_peak // 1024} kB)")
+    print(f"Process RSS: {memory_before['rss']} kB before loading, {memory_loaded['rss']} kB after")
+    for cls, (count, size) in object_sizes((Condition, Rule, StyleChooser)).items():
+        print(f"{cls.__name__}: {count} objects, {size // 1024} kB")
+
+    # Workers touch the inherited style, reference counting copies its pages
+    classes = [(cl, classificator[cl]) for cl in class_order]
+    chunks = [(classes[i::options.processes], options.minzoom, options.maxzoom) for i in range(options.processes)]
+    with get_context('fork').Pool(options.processes) as pool:
+        workers = pool.map(query_classes, chunks)
+    for pid, memory in sorted(workers):
+        print(f"Worker {pid}: RSS {memory['rss']} kB, shared {memory.get('shared', '?')} kB, private {memory.get('private', '?')} kB")
+    if all('private' in memory for pid, memory in workers):
+        print(f"Private memory of all workers: {sum(memory['private'] for pid, memory in workers)} kB")
+
+
+if __name__ == '__main__':
+    main()
@@ -7,14 +7,13 @@ from sys import exit
 from itertools import chain
 from multiprocessing import Pool, set_start_method
 from collections import OrderedDict
-import mapcss.webcolors
+from mapcss.Properties import Color, parse_color
 from drules_struct_pb2 import *
 
-whatever_to_hex = mapcss.webcolors.webcolors.whatever_to_hex
-whatever_to_cairo = mapcss.webcolors.webcolors.whatever_to_cairo
-
 PROFILE = False
 MULTIPROCESSING = True
+# Set to mapcss.ParseUnitCache() to share tokenized @import-ed files between styles
+PARSE_UNIT_CACHE = None
 
 # Priority values defined in *.prio.txt files are adjusted
 # to fit into the following "priorities ranges":
@@ -104,12 +103,11 @@ def to_boolean(s):
 def mwm_encode_color(colors, st, prefix='', default='black'):
     if prefix:
         prefix += "-"
-    opacity = hex(255 - int(255 * float(st.get(prefix + "opacity", 1))))
-    # TODO: Refactoring idea: here color is converted from float to hex. While MapCSS class
-    #       reads colors from *.mapcss files and converts to float. How about changing MapCSS
-    #       to keep hex values and avoid Hex->Float->Hex operations?
-    color = whatever_to_hex(st.get(prefix + 'color', default))[1:]
-    result = int(opacity + color, 16)
+    color = st.get(prefix + 'color', default)
+    if type(color) != Color:
+        # Default color name
+        color = parse_color(color)
+    result = color.argb(float(st.get(prefix + "opacity", 1)))
     colors.add(result)
     return result
 
@@ -459,6 +457,119 @@ def get_drape_priority(cl, dr_type, object_id, auto_dr_type = None, auto_comment
     return 0
 
 
+def load_classificator(ddir, types_file=None):
+    """
+    Parses mapcss-mapping.csv of the data path, the format is described
+    inside the file itself. Returns (classificator, class_order, class_tree):
+    class -> tags of non-obsolete classes, their sorted names and
+    class -> type name of all classes. Lines of types.txt are written to
+    `types_file` if it's given.
+    """
+    classificator = {}
+    class_order = []
+    class_tree = {}
+
+    def print_type(line):
+        if types_file is not None:
+            print(line, file=types_file)
+
+    cnt = 1
+    unique_types_check = set()
+    with open(os.path.join(ddir, 'mapcss-mapping.csv')) as mapping_file:
+        for row in csv.reader(mapping_file, delimiter=';'):
+            if len(row) <= 1 or row[0].startswith('#'):
+                # Allow for empty lines and comment lines starting with '#'.
+                continue
+            if len(row) == 3:
+                # Short format: type name, type id, x / replacement type name
+                tag = row[0].replace('|', '=')
+                obsolete = len(row[2].strip()) > 0
+                row = (row[0], '[{0}]'.format(tag), 'x' if obsolete else '', 'name', 'int_name', row[1], row[2] if row[2] != 'x' else '')
+            if len(row) != 7:
+                raise Exception('Expecting 3 or 7 columns in mapcss-mapping: {0}'.format(';'.join(row)))
+
+            if int(row[5]) < cnt:
+                raise Exception('Wrong type id: {0}'.format(';'.join(row)))
+            while int(row[5]) > cnt:
+                print_type("mapswithme")
+                cnt += 1
+            cnt += 1
+
+            cl = row[0].replace("|", "-")
+            if cl in unique_types_check and row[2] != 'x':
+                raise Exception('Duplicate type: {0}'.format(row[0]))
+            pairs = [i.strip(']').split("=") for i in row[1].split(',')[0].split('[')]
+            kv = OrderedDict()
+            for i in pairs:
+                if len(i) == 1:
+                    if i[0]:
+                        if i[0][0] == "!":
+                            kv[i[0][1:].strip('?')] = "no"
+                        else:
+                            kv[i[0].strip('?')] = "yes"
+                else:
+                    kv[i[0]] = i[1]
+            if row[2] != "x":
+                classificator[cl] = kv
+                class_order.append(cl)
+                unique_types_check.add(cl)
+                # Mark original type to distinguish it among replacing types.
+                print_type("*" + row[0])
+            else:
+                # compatibility mode
+                if row[6]:
+                    print_type(row[6])
+                else:
+                    print_type("mapswithme")
+            class_tree[cl] = row[0]
+    class_order.sort()
+    return classificator, class_order, class_tree
+
+
+def load_dynamic_tags(ddir):
+    """
+    Returns set of mapcss dynamic tags from mapcss-dynamic.txt of the data path
+    """
+    with open(os.path.join(ddir, 'mapcss-dynamic.txt')) as dynamic_file:
+        return set([line.rstrip() for line in dynamic_file])
+
+
+def load_style(options, ddir, classificator, class_order):
+    """
+    Parses the style of options.filename and builds its choosers trees for
+    the classes, see load_classificator()
+    """
+    # Get all mapcss static tags which are used in mapcss-mapping.csv
+    # This is a dict with main_tag flags (True = appears first in types)
+    mapcss_static_tags = {}
+    for v in list(classificator.values()):
+        for i, t in enumerate(v.keys()):
+            mapcss_static_tags[t] = mapcss_static_tags.get(t, True) and i == 0
+
+    # Parse style mapcss
+    result = MapCSS(options.minzoom, options.maxzoom)
+    result.parse(clamp=False, stretch=LAYER_PRIORITY_RANGE,
+                 filename=options.filename, static_tags=mapcss_static_tags,
+                 dynamic_tags=load_dynamic_tags(ddir), cache_dir=getattr(options, 'cache_dir', None),
+                 unit_cache=PARSE_UNIT_CACHE, processes=getattr(options, 'parse_processes', None))
+
+    # Build optimization tree - class/zoom/type -> StyleChoosers
+    clname_cltag_unique = set()
+    for cl in class_order:
+        clname = cl if cl.find('-') == -1 else cl[:cl.find('-')]
+        # Get first tag of the class/type.
+        cltag = next(iter(classificator[cl].keys()))
+        clname_cltag = clname + '$' + cltag
+        if clname_cltag not in clname_cltag_unique:
+            clname_cltag_unique.add(clname_cltag)
+            result.build_choosers_tree(clname, "line", cltag)
+            result.build_choosers_tree(clname, "area", cltag)
+            result.build_choosers_tree(clname, "node", cltag)
+
+    result.finalize_choosers_tree()
+    return result
+
+
 # TODO: Split large function to smaller ones
 def komap_mapswithme(options):
     if options.data and os.path.isdir(options.data):
@@ -466,10 +577,6 @@ def komap_mapswithme(options):
     else:
         ddir = os.path.dirname(options.outfile)
 
-    classificator = {}
-    class_order = []
-    class_tree = {}
-
     # TODO: Introduce new function to parse `colors.txt` for better testability
     colors_file_name = os.path.join(ddir, 'colors.txt')
     colors = set()
@@ -493,104 +600,17 @@ def komap_mapswithme(options):
         patterns_in_file.close()
 
     # Build classificator tree from mapcss-mapping.csv file
-    types_file = open(os.path.join(ddir, 'types.txt'), "w")
-
-    # The mapcss-mapping.csv format is described inside the file itself.
-    # TODO: introduce new function to parse 'mapcss-mapping.csv' for better testability
-    cnt = 1
-    unique_types_check = set()
-    mapping_file = open(os.path.join(ddir, 'mapcss-mapping.csv'))
-    for row in csv.reader(mapping_file, delimiter=';'):
-        if len(row) <= 1 or row[0].startswith('#'):
-            # Allow for empty lines and comment lines starting with '#'.
-            continue
-        if len(row) == 3:
-            # Short format: type name, type id, x / replacement type name
-            tag = row[0].replace('|', '=')
-            obsolete = len(row[2].strip()) > 0
-            row = (row[0], '[{0}]'.format(tag), 'x' if obsolete else '', 'name', 'int_name', row[1], row[2] if row[2] != 'x' else '')
-        if len(row) != 7:
-            raise Exception('Expecting 3 or 7 columns in mapcss-mapping: {0}'.format(';'.join(row)))
-
-        if int(row[5]) < cnt:
-            raise Exception('Wrong type id: {0}'.format(';'.join(row)))
-        while int(row[5]) > cnt:
-            print("mapswithme", file=types_file)
-            cnt += 1
-        cnt += 1
-
-        cl = row[0].replace("|", "-")
-        if cl in unique_types_check and row[2] != 'x':
-            raise Exception('Duplicate type: {0}'.format(row[0]))
-        pairs = [i.strip(']').split("=") for i in row[1].split(',')[0].split('[')]
-        kv = OrderedDict()
-        for i in pairs:
-            if len(i) == 1:
-                if i[0]:
-                    if i[0][0] == "!":
-                        kv[i[0][1:].strip('?')] = "no"
-                    else:
-                        kv[i[0].strip('?')] = "yes"
-            else:
-                kv[i[0]] = i[1]
-        if row[2] != "x":
-            classificator[cl] = kv
-            class_order.append(cl)
-            unique_types_check.add(cl)
-            # Mark original type to distinguish it among replacing types.
-            print("*" + row[0], file=types_file)
-        else:
-            # compatibility mode
-            if row[6]:
-                print(row[6], file=types_file)
-            else:
-                print("mapswithme", file=types_file)
-        class_tree[cl] = row[0]
-    class_order.sort()
-    mapping_file.close()
-    types_file.close()
+    with open(os.path.join(ddir, 'types.txt'), "w") as types_file:
+        classificator, class_order, class_tree = load_classificator(ddir, types_file)
 
     output = ''
     for prio_range in prio_ranges.keys():
-        load_priorities(prio_range, options.priorities_path, unique_types_check, compress = False)
+        load_priorities(prio_range, options.priorities_path, set(class_order), compress = False)
         output += f'{"" if not output else ", "}{len(prio_ranges[prio_range]["priorities"])} {prio_range}'
     print(f'Loaded priorities: {output}.')
 
-    del unique_types_check
-
-    # Get all mapcss static tags which are used in mapcss-mapping.csv
-    # This is a dict with main_tag flags (True = appears first in types)
-    mapcss_static_tags = {}
-    for v in list(classificator.values()):
-        for i, t in enumerate(v.keys()):
-            mapcss_static_tags[t] = mapcss_static_tags.get(t, True) and i == 0
-
-    # TODO: Introduce new function to parse `mapcss-dynamic.txt` for better testability
-    # Get all mapcss dynamic tags from mapcss-dynamic.txt
-    with open(os.path.join(ddir, 'mapcss-dynamic.txt')) as dynamic_file:
-        mapcss_dynamic_tags = set([line.rstrip() for line in dynamic_file])
-
-    # Parse style mapcss
     global style
-    style = MapCSS(options.minzoom, options.maxzoom)
-    style.parse(clamp=False, stretch=LAYER_PRIORITY_RANGE,
-                filename=options.filename, static_tags=mapcss_static_tags,
-                dynamic_tags=mapcss_dynamic_tags)
-
-    # Build optimization tree - class/zoom/type -> StyleChoosers
-    clname_cltag_unique = set()
-    for cl in class_order:
-        clname = cl if cl.find('-') == -1 else cl[:cl.find('-')]
-        # Get first tag of the class/type.
-        cltag = next(iter(classificator[cl].keys()))
-        clname_cltag = clname + '$' + cltag
-        if clname_cltag not in clname_cltag_unique:
-            clname_cltag_unique.add(clname_cltag)
-            style.build_choosers_tree(clname, "line", cltag)
-            style.build_choosers_tree(clname, "area", cltag)
-            style.build_choosers_tree(clname, "node", cltag)
-
-    style.finalize_choosers_tree()
+    style = load_style(options, ddir, classificator, class_order)
 
     # TODO: Introduce new function to work with colors for better testability
     # Get colors section from style
@@ -987,6 +1007,10 @@ def main():
                       help="path to priorities *.prio.txt files", metavar="PATH")
     parser.add_option("-d", "--data-path", dest="data",
                       help="path to mapcss-mapping.csv and other files", metavar="PATH")
+    parser.add_option("-c", "--cache-dir", dest="cache_dir",
+                      help="cache parsed stylesheets in DIR to skip parsing of unchanged styles", metavar="DIR")
+    parser.add_option("-j", "--parse-processes", dest="parse_processes", type="int",
+                      help="tokenize imported stylesheets in N processes", metavar="N")
 
     (options, args) = parser.parse_args()
 
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This file is part of kothic, the realtime map renderer.
+
+#   kothic is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+
+#   kothic is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License
+#   along with kothic.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Generates Python functions which test tags against StyleChooser.ruleChains.
+
+The generated function does the same as StyleChooser.testChains() with
+Rule.test() and Condition.test() inlined: it returns (rule, subpart) for the
+first matched rule or False.
+"""
+
+from .Condition import Number, NUMERIC_OPERATORS, is_subpart, merge_regex_conditions
+
+# Set to False to test rules with Rule.test() instead of generated functions, e.g. for debugging
+ENABLED = True
+
+# Conditions of all rules -> function which binds generated code to the rules
+CHAINS_MEMO = {}
+
+
+class Constants:
+    """
+    Names of values used in generated code
+    """
+
+    def __init__(self):
+        self.values = {'Number': Number}
+
+    def add(self, value):
+        name = "c%d" % len(self.values)
+        self.values[name] = value
+        return name
+
+
+def condition_source(condition, constants):
+    """
+    Returns Python expression testing `tags` against condition, see Condition.make_test()
+    """
+    t = condition.type
+    params = condition.params
+    key = params[0]
+
+    if t == 'eq':
+        return "tags_get(%s) == %s" % (constants.add(key), constants.add(params[1]))
+    if t == 'ne':
+        return "tags_get(%s) != %s" % (constants.add(key), constants.add(params[1]))
+    if t == 'true':
+        return "tags_get(%s) == 'yes'" % constants.add(key)
+    if t == 'untrue':
+        return "tags_get(%s) == 'no'" % constants.add(key)
+    if t == 'set':
+        return "tags_get(%s, '') != ''" % constants.add(key)
+    if t == 'unset':
+        return "tags_get(%s, '') == ''" % constants.add(key)
+    if t == 'regex':
+        key = constants.add(key)
+        return "(%s in tags and %s(tags[%s]) is not None)" % (key, constants.add(condition.regex.match), key)
+    if t in NUMERIC_OPERATORS:
+        key = constants.add(key)
+        return "(%s in tags and Number(tags[%s]) %s %s)" % (key, key, t, constants.add(Number(params[1])))
+
+    return "False"
+
+
+def rule_source(conditions, constants):
+    """
+    Returns Python expression testing `tags` against all the conditions
+    and subpart name returned if they match.
+    """
+    subpart = "::default"
+    tests = []
+    for condition in conditions:
+        if is_subpart(condition):
+            # Don't compare tags against sublayers
+            subpart = condition.params[1]
+            if not subpart:
+                tests.append("False")
+        else:
+            tests.append(condition_source(condition, constants))
+    return " and ".join(tests) or "True", subpart
+
+
+def compile_chains(ruleChains):
+    """
+    Returns function testing tags against the rules
+    """
+    key = tuple(tuple(rule.conditions) for rule in ruleChains)
+    make = CHAINS_MEMO.get(key)
+    if make is None:
+        constants = Constants()
+        lines = ["def make(rules):",
+                 "    def test_chains(tags):",
+                 "        tags_get = tags.get"]
+        for i, conditions in enumerate(key):
+            test, subpart = rule_source(conditions, constants)
+            lines.append("        if %s:" % test)
+            lines.append("            return rules[%d], %s" % (i, constants.add(subpart)))
+        lines.append("        return False")
+        lines.append("    return test_chains")
+
+        exec(compile("\n".join(lines), "<MapCSS rules>", "exec"), constants.values)
+        make = CHAINS_MEMO[key] = constants.values["make"]
+    return make(tuple(ruleChains))
+
+
+def compile_bits(conditions, bit_by_condition):
+    """
+    Returns function which tests tags against all the conditions and returns
+    int with bit `bit_by_condition[condition]` set for each matched condition.
+    """
+    constants = Constants()
+    lines = ["def evaluate(tags):",
+             "    tags_get = tags.get",
+             "    bits = 0"]
+    regex_sets, conditions = merge_regex_conditions(conditions)
+    for condition in conditions:
+        lines.append("    if %s:" % condition_source(condition, constants))
+        lines.append("        bits |= %s" % constants.add(bit_by_condition[condition]))
+    # All regexes on a key are tested by one match()
+    for regex_set in regex_sets:
+        key = constants.add(regex_set.key)
+        lines.append("    if %s in tags:" % key)
+        lines.append("        m = %s(tags[%s])" % (constants.add(regex_set.regex.match), key))
+        for i, condition in enumerate(regex_set.conditions):
+            lines.append("        if m.group(%d) is not None:" % (i + 1))
+            lines.append("            bits |= %s" % constants.add(bit_by_condition[condition]))
+    lines.append("    return bits")
+
+    exec(compile("\n".join(lines), "<MapCSS conditions>", "exec"), constants.values)
+    return constants.values["evaluate"]
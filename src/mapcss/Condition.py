@@ -16,62 +16,111 @@
 #   along with kothic.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import sys
+import operator
+
+NUMERIC_OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+# (type, params) -> Condition
+CONDITIONS = {}
+# Condition.id -> Condition
+CONDITIONS_BY_ID = []
+
+def is_subpart(condition):
+    """
+    ::class condition, it names the subpart of a rule instead of testing tags
+    """
+    return condition.type == 'eq' and condition.params[0][:2] == "::"
+
 
 class Condition:
-    def __init__(self, typez, params):
-        self.type = typez         # eq, regex, lt, gt etc.
+    """
+    Immutable test of a single tag, e.g. [highway=primary]
+
+    Conditions are interned: Condition(type, params) returns the same object
+    for the same type and params, each distinct condition has a stable int `id`.
+    So conditions must not be changed after creation.
+
+    `test(tags)` is a function made for the condition type and params at
+    creation time. It returns subpart name for ::class conditions and bool
+    for all others.
+    """
+    __slots__ = ('type', 'params', 'regex', 'test', 'id')
+
+    def __new__(cls, typez, params):
         if type(params) == type(str()):
             params = (params,)
-        self.params = params      # e.g. ('highway','primary')
+        # Tag keys and values are repeated in many conditions and tags
+        params = tuple(sys.intern(param) if type(param) == str else param for param in params)
+        key = (typez, params)
+        self = CONDITIONS.get(key)
+        if self is not None:
+            return self
+
+        self = object.__new__(cls)
+        object.__setattr__(self, 'type', typez)         # eq, regex, lt, gt etc.
+        object.__setattr__(self, 'params', params)      # e.g. ('highway','primary')
         if typez == "regex":
-            self.regex = re.compile(self.params[1], re.I)
+            object.__setattr__(self, 'regex', re.compile(self.params[1], re.I))
+        object.__setattr__(self, 'test', self.make_test())
+        object.__setattr__(self, 'id', len(CONDITIONS_BY_ID))
+        CONDITIONS[key] = self
+        CONDITIONS_BY_ID.append(self)
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Condition is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Condition is immutable")
+
+    def __reduce__(self):
+        return (Condition, (self.type, self.params))
 
     def extract_tag(self):
         if self.params[0][:2] == "::" or self.type == "regex":
             return "*" # unknown
         return self.params[0]
 
-    def test(self, tags):
+    def make_test(self):
         """
-        Test tags against this condition
+        Makes function to test tags against this condition
         """
         t = self.type
         params = self.params
+        key = params[0]
 
         if t == 'eq':
+            value = params[1]
             # Don't compare tags against sublayers
-            if params[0][:2] == "::":
-                return params[1]
-            return (params[0] in tags and tags[params[0]] == params[1])
+            if key[:2] == "::":
+                return lambda tags: value
+            return lambda tags: tags.get(key) == value
         if t == 'ne':
-            return (params[0] not in tags or tags[params[0]] != params[1])
+            value = params[1]
+            return lambda tags: tags.get(key) != value
         if t == 'true':
-            return tags.get(params[0]) == 'yes'
+            return lambda tags: tags.get(key) == 'yes'
         if t == 'untrue':
-            return tags.get(params[0]) == 'no'
+            return lambda tags: tags.get(key) == 'no'
         if t == 'set':
-            if params[0] in tags:
-                return tags[params[0]] != ''
-            return False
+            return lambda tags: tags.get(key, '') != ''
         if t == 'unset':
-            if params[0] in tags:
-                return tags[params[0]] == ''
-            return True
-
-        if params[0] not in tags:
-            return False
+            return lambda tags: tags.get(key, '') == ''
         if t == 'regex':
-            return bool(self.regex.match(tags[params[0]]))
-        if t == '<':
-            return (Number(tags[params[0]]) < Number(params[1]))
-        if t == '<=':
-            return (Number(tags[params[0]]) <= Number(params[1]))
-        if t == '>':
-            return (Number(tags[params[0]]) > Number(params[1]))
-        if t == '>=':
-            return (Number(tags[params[0]]) >= Number(params[1]))
+            match = self.regex.match
+            return lambda tags: key in tags and bool(match(tags[key]))
+        if t in NUMERIC_OPERATORS:
+            compare = NUMERIC_OPERATORS[t]
+            value = Number(params[1])
+            return lambda tags: key in tags and compare(Number(tags[key]), value)
 
-        return False
+        return lambda tags: False
 
     def __repr__(self):
         t = self.type
@@ -103,11 +152,79 @@ class Condition:
         return "%s %s " % (self.type, repr(self.params))
 
     def __eq__(self, a):
-        return (self.params == a.params) and (self.type == a.type)
+        return self is a or ((self.params == a.params) and (self.type == a.type))
+
+    def __hash__(self):
+        return self.id
 
     def __lt__(self, a):
         return (self.params < a.params) or (self.type < a.type)
 
+class RegexSet:
+    """
+    Regex conditions on one key merged into a single regex: each pattern is
+    an optional lookahead with its own group. One match() of a tag value
+    tells which of the conditions match.
+    """
+
+    def __init__(self, key, conditions):
+        self.key = key
+        self.conditions = conditions
+        self.regex = re.compile(''.join('(?:(?=(?P<r%d>%s)))?' % (i, condition.params[1])
+                                        for i, condition in enumerate(conditions)), re.I)
+
+    def test(self, value):
+        """
+        Returns list of conditions which match tag value
+        """
+        m = self.regex.match(value)
+        return [condition for i, condition in enumerate(self.conditions) if m.group(i + 1) is not None]
+
+
+# Condition -> can it be merged into RegexSet
+MERGEABLE_REGEX = {}
+# Tuple of conditions -> RegexSet
+REGEX_SETS = {}
+
+def can_merge_regex(condition):
+    """
+    Pattern with own groups can't be merged, its backreferences would
+    point to wrong groups
+    """
+    mergeable = MERGEABLE_REGEX.get(condition)
+    if mergeable is None:
+        mergeable = not condition.regex.groups
+        if mergeable:
+            try:
+                re.compile('(?=(%s))' % condition.params[1], re.I)
+            except re.error:
+                mergeable = False
+        MERGEABLE_REGEX[condition] = mergeable
+    return mergeable
+
+
+def merge_regex_conditions(conditions):
+    """
+    Splits conditions into RegexSet's of regex conditions on the same key and
+    the rest of conditions
+    """
+    by_key = {}
+    for condition in conditions:
+        if condition.type == 'regex' and can_merge_regex(condition):
+            by_key.setdefault(condition.params[0], []).append(condition)
+    regex_sets = []
+    merged = set()
+    for key, key_conditions in by_key.items():
+        if len(key_conditions) > 1:
+            key_conditions = tuple(key_conditions)
+            regex_set = REGEX_SETS.get(key_conditions)
+            if regex_set is None:
+                regex_set = REGEX_SETS[key_conditions] = RegexSet(key, key_conditions)
+            regex_sets.append(regex_set)
+            merged.update(key_conditions)
+    return regex_sets, [condition for condition in conditions if condition not in merged]
+
+
 def Number(tt):
     """
     Wrap float() not to produce exceptions
@@ -15,11 +15,122 @@
 #   You should have received a copy of the GNU General Public License
 #   along with kothic.  If not, see <http://www.gnu.org/licenses/>.
 
+import ast
 import logging
+from collections import OrderedDict
 
 logger = logging.getLogger('mapcss.Eval')
 logger.setLevel(logging.ERROR)
 
+# MapCSS function -> (number of arguments or None for any, Python expression it's compiled to)
+FUNCTIONS = {
+    "tag": (1, "tags.get({0}, '')"),
+    "prop": (1, "props.get({0}, '')"),
+    "num": (1, "m_num({0})"),
+    "metric": (1, "m_metric({0}, xscale)"),
+    "zmetric": (1, "m_metric({0}, zscale)"),
+    "str": (1, "str({0})"),
+    "any": (None, "m_any({0})"),
+    "min": (None, "m_min({0})"),
+    "max": (None, "m_max({0})"),
+    "cond": (3, "m_cond({0})"),
+    "boolean": (1, "m_boolean({0})"),
+}
+
+OPERATORS = {
+    ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/", ast.FloorDiv: "//", ast.Mod: "%", ast.Pow: "**",
+    ast.UAdd: "+", ast.USub: "-", ast.Not: "not",
+    ast.And: "and", ast.Or: "or",
+    ast.Eq: "==", ast.NotEq: "!=", ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">=",
+}
+
+# Expression text -> result of compile_expression(), shared by all Eval's with the same expression
+FUNCTIONS_MEMO = {}
+
+# (expression text, values of tags and props it reads, xscale, zscale) -> result of Eval.compute(),
+# least recently used results are dropped when there are more than RESULTS_MEMO_SIZE of them
+RESULTS_MEMO = OrderedDict()
+RESULTS_MEMO_SIZE = 100000
+
+
+def expression_source(node):
+    """
+    Returns Python source of the parsed expression with MapCSS functions
+    replaced by their implementations. Only constants, operators and calls
+    of FUNCTIONS are allowed, raises Exception for anything else.
+    """
+    if isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+            name = node.func.id if isinstance(node.func, ast.Name) else type(node.func).__name__
+            raise Exception("Unknown function: " + name)
+        arity, source = FUNCTIONS[node.func.id]
+        if node.keywords or (arity is not None and len(node.args) != arity):
+            raise Exception("Wrong arguments of " + node.func.id)
+        return source.format(", ".join(expression_source(arg) for arg in node.args))
+    if isinstance(node, ast.Constant):
+        return repr(node.value)
+    if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+        return "(%s %s %s)" % (expression_source(node.left), OPERATORS[type(node.op)], expression_source(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in OPERATORS:
+        return "(%s %s)" % (OPERATORS[type(node.op)], expression_source(node.operand))
+    if isinstance(node, ast.BoolOp):
+        return "(%s)" % (" %s " % OPERATORS[type(node.op)]).join(expression_source(value) for value in node.values)
+    if isinstance(node, ast.Compare) and all(type(op) in OPERATORS for op in node.ops):
+        parts = [expression_source(node.left)]
+        for op, comparator in zip(node.ops, node.comparators):
+            parts.append(OPERATORS[type(op)])
+            parts.append(expression_source(comparator))
+        return "(%s)" % " ".join(parts)
+    if isinstance(node, ast.IfExp):
+        return "(%s if %s else %s)" % (expression_source(node.body), expression_source(node.test),
+                                       expression_source(node.orelse))
+    raise Exception("Not allowed: " + type(node).__name__)
+
+
+def expression_dependencies(tree):
+    """
+    Returns (tags, props, dynamic) for the parsed expression: tuples of names
+    of tags and properties read by tag() and prop() calls, and set of these
+    functions which are called with a name not known until the expression is
+    computed, e.g. tag(prop("key")).
+    """
+    names = {"tag": {}, "prop": {}}
+    dynamic = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and node.func.id in names:
+            name = node.args[0]
+            if isinstance(name, ast.Constant) and type(name.value) == str:
+                names[node.func.id][name.value] = True
+            else:
+                dynamic.add(node.func.id)
+    return tuple(names["tag"]), tuple(names["prop"]), dynamic
+
+
+def compile_expression(s):
+    """
+    Returns (function, tags, props, dynamic) for expression text `s`:
+    function(tags, props, xscale, zscale) computes the expression, the rest
+    is as returned by expression_dependencies()
+    """
+    result = FUNCTIONS_MEMO.get(s)
+    if result is None:
+        try:
+            tree = ast.parse(s, "MapCSS expression", "eval")
+        except SyntaxError:
+            # print "Can't compile %s" % s
+            tree = ast.parse("0", "MapCSS expression", "eval")
+        source = "lambda tags, props, xscale, zscale: " + expression_source(tree.body)
+        namespace = {"__builtins__": {}, "str": str, "m_num": m_num, "m_metric": m_metric, "m_any": m_any,
+                     "m_min": m_min, "m_max": m_max, "m_cond": m_cond, "m_boolean": m_boolean}
+        function = eval(compile(source, "MapCSS expression", "eval"), namespace)
+        result = FUNCTIONS_MEMO[s] = (function,) + expression_dependencies(tree)
+    return result
+
+
+def invalid_expression(tags, props, xscale, zscale):
+    return ""
+
+
 class Eval():
     def __init__(self, s='eval()'):
         """
@@ -28,69 +139,64 @@ class Eval():
         s = s.strip()[5:-1].strip()
         self.expr_text = s
         try:
-            self.expr = compile(s, "MapCSS expression", "eval")
-        except:
-            # print "Can't compile %s" % s
-            self.expr = compile("0", "MapCSS expression", "eval")
+            self.function, self.tags, self.props, dynamic = compile_expression(s)
+        except Exception as e:
+            logger.warning(f"Invalid expression `{s}`: {e}")
+            # Fails in compute() like an unknown function did in Python eval()
+            self.function, self.tags, self.props, dynamic = invalid_expression, (), (), set()
+        # Names of tags or props read by the expression are known only when it's computed
+        self.has_dynamic_tags = "tag" in dynamic
+        self.has_dynamic_props = "prop" in dynamic
+
+    def __getstate__(self):
+        # Compiled code can't be pickled, compile it again on load
+        return self.expr_text
+
+    def __setstate__(self, state):
+        self.__init__("eval(" + state + ")")
 
     def extract_tags(self):
         """
-        Extracts list of tags that might be used in calculation
+        Returns set of tags used in calculation, {"*"} if any tag may be used
         """
-        def fake_compute(*x):
-            """
-            Perform a fake computation. Always computes all the parameters, always returns 0.
-            WARNING: Might not cope with complex statements.
-            """
-            for t in x:
-                q = x
-            return 0
-
-        # print self.expr_text
-        tags = set([])
-        def tags_add(x):
-            tags.add(x)
-            return 0
-        a = eval(self.expr, {}, {
-                 "tag": lambda x: tags_add(x),
-                 "prop": lambda x: 0,
-                 "num": lambda x: 0,
-                 "metric": fake_compute,
-                 "zmetric": fake_compute,
-                 "str": lambda x: "",
-                 "any": fake_compute,
-                 "min": fake_compute,
-                 "max": fake_compute,
-                 "cond": fake_compute,
-                 "boolean": fake_compute,
-                 })
-        return tags
+        if self.has_dynamic_tags:
+            return set("*")
+        return set(self.tags)
 
-    def compute(self, tags={}, props={}, xscale=1., zscale=0.5):
+    def extract_props(self):
         """
-        Compute this eval()
+        Returns set of properties used in calculation, {"*"} if any property may be used
         """
+        if self.has_dynamic_props:
+            return set("*")
+        return set(self.props)
+
+    def compute(self, tags={}, props={}, xscale=1., zscale=0.5):
         """
-        for k, v in tags.iteritems():
-            try:
-                tags[k] = float(v)
-            except:
-                pass
+        Compute this eval()
         """
+        if self.has_dynamic_tags or self.has_dynamic_props:
+            return self.compute_result(tags, props, xscale, zscale)
+
+        # Result depends only on values of the tags and props read by the expression
+        key = (self.expr_text, tuple([tags.get(name, '') for name in self.tags]),
+               tuple([(type(value), value) for value in [props.get(name, '') for name in self.props]]), xscale, zscale)
+        try:
+            result = RESULTS_MEMO[key]
+        except KeyError:
+            result = RESULTS_MEMO[key] = self.compute_result(tags, props, xscale, zscale)
+            if len(RESULTS_MEMO) > RESULTS_MEMO_SIZE:
+                RESULTS_MEMO.popitem(last=False)
+            return result
+        except TypeError:
+            # Unhashable value, e.g. list of dashes
+            return self.compute_result(tags, props, xscale, zscale)
+        RESULTS_MEMO.move_to_end(key)
+        return result
+
+    def compute_result(self, tags, props, xscale, zscale):
         try:
-            result = eval(self.expr, {}, {
-                            "tag": lambda x: tags.get(x, ""),
-                            "prop": lambda x: props.get(x, ""),
-                            "num": m_num,
-                            "metric": lambda x: m_metric(x, xscale),
-                            "zmetric": lambda x: m_metric(x, zscale),
-                            "str": str,
-                            "any": m_any,
-                            "min": m_min,
-                            "max": m_max,
-                            "cond": m_cond,
-                            "boolean": m_boolean
-                            })
+            result = self.function(tags, props, xscale, zscale)
 
             if type(result) == float:
                 # In Python2 and Python3 float to string behaves differently
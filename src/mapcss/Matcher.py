@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This file is part of kothic, the realtime map renderer.
+
+#   kothic is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+
+#   kothic is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License
+#   along with kothic.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+
+from . import Codegen
+from .Condition import is_subpart, merge_regex_conditions
+
+
+def is_anchor(condition):
+    """
+    Equality condition on a tag, a rule with it can match only objects with this tag value
+    """
+    return condition.type == 'eq' and not is_subpart(condition)
+
+
+class ChooserIndex:
+    """
+    Inverted index of choosers of one object type: tag key -> choosers which
+    test this tag. Choosers which may match any tags (e.g. with regex
+    conditions) are kept apart and are returned for every key.
+    """
+
+    def __init__(self, choosers):
+        self.choosers = choosers
+        self.by_key = {} # key -> indexes of choosers
+        self.wildcard = [] # indexes of choosers
+        for i, chooser in enumerate(choosers):
+            chooser_tags = chooser.extract_tags()
+            if '*' in chooser_tags:
+                self.wildcard.append(i)
+            else:
+                for tag in chooser_tags:
+                    self.by_key.setdefault(tag, []).append(i)
+
+    def get_choosers(self, key):
+        """
+        Returns choosers which may match objects with the tag key, in cascade order
+        """
+        return [self.choosers[i] for i in heapq.merge(self.by_key.get(key, ()), self.wildcard)]
+
+
+class ZoomIndex:
+    """
+    Choosers of one class and object type on all zooms. Each chooser and each
+    of its rules is stored once with a mask of zooms it applies to: bit `zoom`
+    is set for every zoom in the range. Choosers of a zoom are a filtered view
+    of the index, see get_choosers().
+    """
+
+    def __init__(self, minzoom, maxzoom):
+        self.minzoom = minzoom
+        self.maxzoom = maxzoom
+        # [(chooser, zooms, ((rule, zooms), ...)), ...] in cascade order,
+        # rules are filled in by finalize()
+        self.entries = []
+        self.chooser_set = set()
+
+    def zooms_mask(self, minzoom, maxzoom):
+        """
+        Returns mask of zooms of the index in [minzoom, maxzoom] range
+        """
+        minzoom = max(self.minzoom, minzoom)
+        maxzoom = min(self.maxzoom, maxzoom)
+        if minzoom > maxzoom:
+            return 0
+        return (1 << (maxzoom + 1)) - (1 << minzoom)
+
+    def add(self, chooser):
+        if chooser not in self.chooser_set:
+            self.chooser_set.add(chooser)
+            self.entries.append((chooser, self.zooms_mask(chooser.selzooms[0], chooser.selzooms[1]), ()))
+
+    def finalize(self, ftype):
+        """
+        Keeps rules of choosers which match the object type and zooms of the chooser
+        """
+        entries = []
+        for chooser, zooms, rules in self.entries:
+            rules = []
+            for rule in chooser.ruleChains:
+                if rule.matches_type(ftype):
+                    rule_zooms = zooms & self.zooms_mask(rule.minZoom, rule.maxZoom)
+                    if rule_zooms:
+                        rules.append((rule, rule_zooms))
+            entries.append((chooser, zooms, tuple(rules)))
+        self.entries = entries
+        # Discard unneeded unique set of choosers.
+        self.chooser_set = None
+
+    def get_choosers(self, zoom):
+        """
+        Returns list of (chooser, rules) for choosers on the zoom, `rules` are
+        the chooser's rules which apply to the zoom
+        """
+        bit = 1 << zoom
+        return [(chooser, tuple(rule for rule, rule_zooms in rules if rule_zooms & bit))
+                for chooser, zooms, rules in self.entries if zooms & bit]
+
+    def get_zooms(self):
+        return range(self.minzoom, self.maxzoom + 1)
+
+    def get_lists(self):
+        """
+        Returns (lists, list_by_zoom): distinct results of get_choosers() on
+        all zooms and a dict zoom -> index in `lists`. Neighbour zooms usually
+        have the same choosers and rules, such zooms share one list.
+        """
+        lists = []
+        list_by_zoom = {}
+        list_indexes = {}
+        for zoom in self.get_zooms():
+            choosers = self.get_choosers(zoom)
+            key = tuple((id(chooser), tuple(id(rule) for rule in rules)) for chooser, rules in choosers)
+            if key not in list_indexes:
+                list_indexes[key] = len(lists)
+                lists.append(choosers)
+            list_by_zoom[zoom] = list_indexes[key]
+        return lists, list_by_zoom
+
+
+class ConditionBits:
+    """
+    Results of conditions tests for the last tag set, shared by all the
+    matchers of a style. Each condition of the style has its own bit, see
+    get_bit(). The bit is set in `bits` if the condition matches tags,
+    `tested` has bits of conditions tested so far.
+    """
+
+    def __init__(self):
+        # Bits are numbered per style, so masks are as wide as the number
+        # of conditions of the style rather than of all parsed styles
+        self.bit_by_condition = {} # condition -> bit
+        self.conditions = [] # bit index -> condition
+        self.tags_items = None
+        self.bits = 0
+        self.tested = 0
+        self.generation = 0 # changes with tags
+
+    def get_bit(self, condition):
+        bit = self.bit_by_condition.get(condition)
+        if bit is None:
+            bit = self.bit_by_condition[condition] = 1 << len(self.conditions)
+            self.conditions.append(condition)
+        return bit
+
+    def test(self, mask, tags):
+        """
+        Tests tags against conditions of bits set in `mask`.
+        Returns bits of matched conditions.
+        """
+        bits = 0
+        regex_conditions = []
+        while mask:
+            bit = mask & -mask
+            condition = self.conditions[bit.bit_length() - 1]
+            if condition.type == 'regex':
+                regex_conditions.append(condition)
+            elif condition.test(tags):
+                bits |= bit
+            mask ^= bit
+
+        if len(regex_conditions) > 1:
+            regex_sets, regex_conditions = merge_regex_conditions(regex_conditions)
+            for regex_set in regex_sets:
+                if regex_set.key in tags:
+                    for condition in regex_set.test(tags[regex_set.key]):
+                        bits |= self.bit_by_condition[condition]
+        for condition in regex_conditions:
+            if condition.test(tags):
+                bits |= self.bit_by_condition[condition]
+        return bits
+
+    def set_tags(self, tags):
+        # Styles are queried for the same tags on all zooms and types, test conditions once
+        tags_items = tuple(tags.items())
+        if tags_items != self.tags_items:
+            self.tags_items = tags_items
+            self.bits = 0
+            self.tested = 0
+            self.generation += 1
+
+
+class Matcher:
+    """
+    Base of matchers of tags against choosers of one class and object type
+    on all zooms. Subclasses make a list of their own entries for each
+    distinct list of choosers, see make_list(), and match tags against it
+    in match_list().
+    """
+
+    def __init__(self, zoom_index):
+        """
+        `zoom_index` is a ZoomIndex finalized by MapCSS.finalize_choosers_tree()
+        """
+        lists, self.list_by_zoom = zoom_index.get_lists() # zoom -> index in self.lists
+        self.lists = [self.make_list(choosers) for choosers in lists]
+        self.last_matches = {} # index in self.lists -> matches for the current tags
+
+    def make_list(self, choosers):
+        raise NotImplementedError
+
+    def match_list(self, entries, tags):
+        raise NotImplementedError
+
+    def set_tags(self, tags):
+        """
+        Returns True if tags differ from the previous call
+        """
+        raise NotImplementedError
+
+    def match(self, tags, zoom):
+        """
+        Returns list of (chooser, rule, subpart) for each chooser on the zoom
+        which matches tags, in the choosers order. `rule` is the first matched
+        rule of the chooser, the same as StyleChooser.testChains() returns.
+        """
+        # Styles are queried for the same tags several times on each zoom, match them once
+        list_index = self.list_by_zoom[zoom]
+        if self.set_tags(tags):
+            self.last_matches = {}
+        else:
+            matches = self.last_matches.get(list_index)
+            if matches is not None:
+                return matches
+
+        matches = self.match_list(self.lists[list_index], tags)
+        self.last_matches[list_index] = matches
+        return matches
+
+
+class BitsetMatcher(Matcher):
+    """
+    Matches tags against choosers of one class and object type on all zooms.
+
+    Each rule is a mask with bits of its conditions, a rule matches
+    when `bits & mask == mask`. Conditions are tested into ConditionBits
+    shared by all the matchers, so a condition used by several matchers is
+    tested once per tag set.
+    """
+
+    def __init__(self, zoom_index, condition_bits):
+        """
+        `zoom_index` is a ZoomIndex finalized by MapCSS.finalize_choosers_tree()
+        """
+        self.condition_bits = condition_bits
+        self.conditions = []
+        self.mask = 0 # bits of all the conditions
+        # self.lists: [[(chooser, anchors, ((mask, rule, subpart), ...)), ...], ...]
+        Matcher.__init__(self, zoom_index)
+        self.generation = None
+        if Codegen.ENABLED:
+            self.evaluate = Codegen.compile_bits(self.conditions, condition_bits.bit_by_condition)
+        else:
+            self.evaluate = self.evaluate_conditions
+
+    def make_list(self, choosers):
+        return [self.make_entry(chooser, rules) for chooser, rules in choosers]
+
+    def make_entry(self, chooser, rules):
+        """
+        Returns (chooser, anchors, rules). `anchors` is a mask of equality
+        conditions such that each rule of the chooser has one of them. Chooser
+        can't match tags which don't agree with any of these conditions.
+        It's 0 if some rule has no equality condition.
+        """
+        anchors = 0
+        for rule in rules:
+            anchor = next((condition for condition in rule.conditions if is_anchor(condition)), None)
+            if anchor is None:
+                anchors = 0
+                break
+            anchors |= self.condition_bits.get_bit(anchor)
+        return chooser, anchors, tuple(self.make_rule(rule) for rule in rules)
+
+    def make_rule(self, rule):
+        """
+        Returns (mask, rule, subpart) for the rule, see Rule.test()
+        """
+        mask = 0
+        subpart = "::default"
+        for condition in rule.conditions:
+            if is_subpart(condition):
+                # Don't compare tags against sublayers
+                subpart = condition.params[1]
+                if not subpart:
+                    # Never matches
+                    mask = -1
+            elif mask != -1:
+                bit = self.condition_bits.get_bit(condition)
+                if not self.mask & bit:
+                    self.mask |= bit
+                    self.conditions.append(condition)
+                mask |= bit
+        return mask, rule, subpart
+
+    def evaluate_conditions(self, tags):
+        return self.condition_bits.test(self.mask, tags)
+
+    def set_tags(self, tags):
+        """
+        Tests conditions not tested yet by other matchers for the tags
+        """
+        condition_bits = self.condition_bits
+        condition_bits.set_tags(tags)
+        if self.generation == condition_bits.generation:
+            return False
+        self.generation = condition_bits.generation
+        untested = self.mask & ~condition_bits.tested
+        if untested:
+            if untested == self.mask:
+                condition_bits.bits |= self.evaluate(tags)
+            else:
+                condition_bits.bits |= condition_bits.test(untested, tags)
+            condition_bits.tested |= untested
+        return True
+
+    def match_list(self, entries, tags):
+        bits = self.condition_bits.bits
+        matches = []
+        for chooser, anchors, rules in entries:
+            if anchors and not bits & anchors:
+                continue
+            for mask, rule, subpart in rules:
+                if bits & mask == mask:
+                    matches.append((chooser, rule, subpart))
+                    break
+        return matches
+
+
+class TreeMatcher(Matcher):
+    """
+    Matches tags against choosers of one class and object type on all zooms
+    with a discrimination tree.
+
+    A branch node tests the tag key used in equality conditions of most of
+    its rules: rules with [key=value] go to the child for the value, other
+    rules to a separate child. Only the child for the actual tag value and
+    the other child are visited, so a query looks at a small part of rules.
+    Leaf rules test their remaining conditions one by one.
+    """
+    # Don't branch nodes with fewer rules
+    LEAF_SIZE = 4
+
+    def __init__(self, zoom_index):
+        """
+        `zoom_index` is a ZoomIndex finalized by MapCSS.finalize_choosers_tree()
+        """
+        # self.lists: [(choosers, tree), ...]
+        Matcher.__init__(self, zoom_index)
+        self.last_tags = None
+
+    def make_list(self, choosers):
+        return [chooser for chooser, rules in choosers], self.make_tree(choosers)
+
+    def make_tree(self, choosers):
+        rules = []
+        for chooser_index, (chooser, chooser_rules) in enumerate(choosers):
+            for rule_index, rule in enumerate(chooser_rules):
+                subpart = "::default"
+                conditions = []
+                for condition in rule.conditions:
+                    if is_subpart(condition):
+                        # Don't compare tags against sublayers
+                        subpart = condition.params[1]
+                    else:
+                        conditions.append(condition)
+                if subpart:
+                    rules.append(((chooser_index, rule_index), tuple(conditions), rule, subpart))
+        return self.make_node(rules)
+
+    def make_node(self, rules):
+        """
+        Returns (None, rules) for a leaf and (key, {value: node}, other node) for a branch
+        """
+        counts = {}
+        for order, conditions, rule, subpart in rules:
+            for key in set(condition.params[0] for condition in conditions if is_anchor(condition)):
+                counts[key] = counts.get(key, 0) + 1
+        if len(rules) <= self.LEAF_SIZE or not counts or max(counts.values()) < 2:
+            return (None, rules)
+
+        key = max(counts, key=counts.get)
+        by_value = {}
+        other = []
+        for order, conditions, rule, subpart in rules:
+            anchor = next((condition for condition in conditions if is_anchor(condition) and condition.params[0] == key), None)
+            if anchor is None:
+                other.append((order, conditions, rule, subpart))
+            else:
+                remaining = tuple(condition for condition in conditions if condition is not anchor)
+                by_value.setdefault(anchor.params[1], []).append((order, remaining, rule, subpart))
+        children = dict((value, self.make_node(value_rules)) for value, value_rules in by_value.items())
+        return (key, children, self.make_node(other))
+
+    def collect(self, node, tags, found):
+        """
+        Adds matched rules of the node to `found`: (chooser index, rule index) -> (rule, subpart)
+        """
+        while node[0] is not None:
+            key, children, other = node
+            if key in tags:
+                child = children.get(tags[key])
+                if child is not None:
+                    self.collect(child, tags, found)
+            node = other
+        for order, conditions, rule, subpart in node[1]:
+            for condition in conditions:
+                if not condition.test(tags):
+                    break
+            else:
+                found[order] = (rule, subpart)
+
+    def set_tags(self, tags):
+        tags_items = tuple(tags.items())
+        if tags_items == self.last_tags:
+            return False
+        self.last_tags = tags_items
+        return True
+
+    def match_list(self, entries, tags):
+        choosers, tree = entries
+        found = {}
+        self.collect(tree, tags, found)
+        matches = []
+        last_chooser_index = None
+        # Cascade order, the first matched rule of each chooser
+        for (chooser_index, rule_index), (rule, subpart) in sorted(found.items(), key=lambda item: item[0]):
+            if chooser_index != last_chooser_index:
+                matches.append((choosers[chooser_index], rule, subpart))
+                last_chooser_index = chooser_index
+        return matches
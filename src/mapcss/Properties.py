@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This file is part of kothic, the realtime map renderer.
+
+#   kothic is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+
+#   kothic is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License
+#   along with kothic.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Types of MapCSS style properties.
+
+Each property has a converter from its text value as written in a
+stylesheet (or computed by eval()) to the value stored in styles.
+A converter returns None if the property should be dropped.
+"""
+
+from .webcolors.webcolors import whatever_to_rgb
+
+
+class Color(int):
+    """
+    Color packed into an int 0xRRGGBB. It's stored in styles as is and
+    written into drules with opacity by argb().
+    """
+    __slots__ = ()
+
+    @property
+    def hex(self):
+        """
+        Color as seen by eval(), e.g. '#ff0000'
+        """
+        return '#%06x' % self
+
+    def argb(self, opacity):
+        """
+        Packs color with alpha 0xAARRGGBB, where alpha is transparency: 0 for opaque
+        """
+        return ((255 - int(255 * opacity)) << 24) | self
+
+    def __repr__(self):
+        return "Color('%s')" % self.hex
+
+    def __str__(self):
+        return self.hex
+
+
+# Text of color -> Color
+COLORS = {}
+
+
+def parse_color(value):
+    """
+    Parses CSS3 color name, hex or rgb() into Color
+    """
+    color = COLORS.get(value)
+    if color is None:
+        r, g, b = whatever_to_rgb(value)
+        color = COLORS[value] = Color((int(r) << 16) | (int(g) << 8) | int(b))
+    return color
+
+
+def to_string(value):
+    return value
+
+
+def to_float(value):
+    """
+    Float or not in style at all
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def to_float_list(value):
+    """
+    List of floats, e.g. dashes
+    """
+    if type(value) == list:
+        return value
+    try:
+        return [float(x) for x in value.split(",")]
+    except ValueError:
+        return []
+
+
+def color_converter(none_converter):
+    """
+    Makes converter of colors to Color. "none" is converted by `none_converter`
+    """
+    def to_color(value):
+        if type(value) == Color:
+            # Already converted, e.g. a color from a shared style
+            return value
+        if value.strip() == 'none':
+            return none_converter(value)
+        if value:
+            return parse_color(value)
+        return None
+    return to_color
+
+
+to_color = color_converter(to_string)
+
+# Known properties -> converter
+PROPERTIES = {}
+for name in ('color', 'casing-color', 'fill-color', 'text-color', 'text-halo-color', 'shield-color',
+             'shield-text-color', 'shield-text-halo-color', 'shield-outline-color', 'symbol-fill-color'):
+    PROPERTIES[name] = to_color
+for name in ('width', 'casing-width', 'casing-width-add', 'opacity', 'casing-opacity', 'fill-opacity',
+             'text-opacity', 'text-halo-opacity', 'text-halo-radius', 'text-offset', 'text-offset-x',
+             'text-offset-y', 'shield-opacity', 'shield-text-opacity', 'shield-text-halo-opacity',
+             'shield-text-halo-radius', 'shield-outline-opacity', 'shield-outline-radius', 'symbol-fill-opacity',
+             'pattern-offset'):
+    PROPERTIES[name] = to_float
+for name in ('dashes', 'casing-dashes'):
+    PROPERTIES[name] = to_float_list
+# Enumerations and other text values. Numbers which libkomwm parses itself
+# (font-size may be a list, z-index is stretched by MapCSS.parse()) stay strings too.
+for name in ('linecap', 'linejoin', 'casing-linecap', 'casing-linejoin', 'text-position', 'text-optional',
+             'text', 'icon-image', 'symbol-shape', 'symbol-image', 'pattern-image', 'object-id',
+             'font-size', 'shield-font-size', 'symbol-size', 'pattern-spacing', 'icon-min-distance',
+             'shield-min-distance', 'z-index', 'fill-position'):
+    PROPERTIES[name] = to_string
+
+# Unknown properties -> converter guessed by name
+GUESSED_PROPERTIES = {}
+
+
+def guess_converter(name):
+    """
+    Returns converter for a property by parts of its name, e.g. for colors
+    defined in the colors section
+    """
+    if any(x in name for x in ("width", "opacity", "offset", "radius", "extrude")):
+        converter = to_float
+    elif "dashes" in name:
+        converter = to_float_list
+    else:
+        converter = to_string
+    if "color" in name:
+        converter = color_converter(converter)
+    return converter
+
+
+def get_converter(name):
+    converter = PROPERTIES.get(name)
+    if converter is None:
+        converter = GUESSED_PROPERTIES.get(name)
+        if converter is None:
+            converter = GUESSED_PROPERTIES[name] = guess_converter(name)
+    return converter
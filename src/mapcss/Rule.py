@@ -15,6 +15,8 @@
 #   You should have received a copy of the GNU General Public License
 #   along with kothic.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
+
 type_matches = {
     "": ('area', 'line', 'way', 'node'),
     "area": ("area", "way"),
@@ -23,7 +25,14 @@ type_matches = {
     "line": ("line", "area"),
     }
 
+# Object type -> bit of Rule.types
+TYPE_BITS = {'area': 1, 'line': 2, 'way': 4, 'node': 8}
+# Rule subject -> mask of object types it matches
+TYPE_MASKS = dict((subject, sum(TYPE_BITS[t] for t in types)) for subject, types in type_matches.items())
+
 class Rule():
+    __slots__ = ('runtime_conditions', 'conditions', 'minZoom', 'maxZoom', 'subject', 'types')
+
     def __init__(self, s=''):
         self.runtime_conditions = None
         self.conditions = []
@@ -32,8 +41,15 @@ class Rule():
         self.maxZoom = 19
         if s == "*":
             s = ""
-        self.subject = s    # "", "way", "node" or "relation"
-        self.type_matches = type_matches[s] if s in type_matches else set()
+        self.subject = sys.intern(s)    # "", "way", "node" or "relation"
+        self.types = TYPE_MASKS.get(s, 0) # bits of TYPE_BITS
+
+    @property
+    def type_matches(self):
+        return tuple(t for t, bit in TYPE_BITS.items() if self.types & bit)
+
+    def matches_type(self, ftype):
+        return bool(self.types & TYPE_BITS.get(ftype, 0))
 
     def __repr__(self):
         return "%s|z%s-%s %s %s" % (self.subject, self.minZoom, self.maxZoom, self.conditions, self.runtime_conditions)
@@ -44,7 +60,7 @@ class Rule():
             res = condition.test(tags)
             if not res:
                 return False
-            if type(res) != bool:
+            if res is not True:
                 subpart = res
         return subpart
 
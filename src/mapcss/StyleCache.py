@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#    This file is part of kothic, the realtime map renderer.
+
+#   kothic is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+
+#   kothic is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+
+#   You should have received a copy of the GNU General Public License
+#   along with kothic.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import pickle
+import hashlib
+import logging
+
+# Bump this value when layout of the cached data changes.
+CACHE_VERSION = 4
+
+logger = logging.getLogger('mapcss.StyleCache')
+
+_sources_digest = None
+
+
+def file_digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def sources_digest():
+    """
+    Digest of the mapcss package sources. Any change in the parser code
+    invalidates all the cached styles.
+    """
+    global _sources_digest
+    if _sources_digest is None:
+        h = hashlib.sha256()
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        for root, dirs, files in os.walk(package_dir):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.py'):
+                    with open(os.path.join(root, name), 'rb') as f:
+                        h.update(name.encode('utf-8'))
+                        h.update(f.read())
+        _sources_digest = h.hexdigest()
+    return _sources_digest
+
+
+class StyleCache:
+    """
+    On-disk cache of parsed MapCSS styles.
+
+    Each entry keeps the hashes of all files which were read while parsing
+    the style (the stylesheet itself and everything reached through @import).
+    An entry is used only if none of these files has changed since it was stored.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def make_key(self, *args):
+        """
+        Builds entry key from the parse inputs which are not files contents.
+        """
+        h = hashlib.sha256()
+        h.update(repr((CACHE_VERSION, sources_digest()) + args).encode('utf-8'))
+        return h.hexdigest()
+
+    def entry_filename(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def load(self, key):
+        """
+        Returns cached payload or None if there is no valid entry for the key.
+        """
+        filename = self.entry_filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring broken style cache entry {filename}: {e}")
+            return None
+
+        if entry.get('version') != CACHE_VERSION:
+            return None
+
+        for path, digest in entry['files']:
+            try:
+                with open(path, 'r') as f:
+                    if file_digest(f.read()) != digest:
+                        return None
+            except IOError:
+                return None
+
+        return entry['payload']
+
+    def store(self, key, files, payload):
+        """
+        Stores payload. `files` is a list of (filename, content) pairs which
+        were read to produce the payload.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = {
+            'version': CACHE_VERSION,
+            'files': [(os.path.abspath(path), file_digest(text)) for path, text in files],
+            'payload': payload,
+        }
+        filename = self.entry_filename(key)
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+
+
+class ParseUnitCache:
+    """
+    In-memory cache of tokenized MapCSS files.
+
+    Share one instance between MapCSS.parse() calls to tokenize the files
+    imported by several styles (e.g. by light and dark themes) only once.
+    Variables are substituted by parse() itself, so a cached file is reused
+    whatever variables its importer defines.
+    """
+
+    def __init__(self):
+        self.units = {}
+
+    def get(self, filename, css, tokenize):
+        """
+        Returns statements of the file, calls `tokenize` if file is not cached
+        or its content has changed.
+        """
+        statements = self.find(filename, css)
+        if statements is None:
+            statements = tokenize(css)
+            self.add(filename, css, statements)
+        return statements
+
+    def find(self, filename, css):
+        """
+        Returns cached statements of the file or None.
+        """
+        unit = self.units.get(os.path.abspath(filename))
+        if unit is None or unit[0] != css:
+            return None
+        return unit[1]
+
+    def add(self, filename, css, statements):
+        self.units[os.path.abspath(filename)] = (css, statements)
@@ -16,49 +16,180 @@
 #   along with kothic.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import sys
+
 from .Rule import Rule
-from .webcolors.webcolors import whatever_to_cairo as colorparser
-from .webcolors.webcolors import cairo_to_hex
 from .Eval import Eval
+from .Properties import Color, get_converter
 from .Condition import  *
+from . import Codegen
 
 TYPE_EVAL = type(Eval())
 
 def make_nice_style(r):
+    """
+    Converts values of style properties to their types, see Properties.PROPERTIES
+    """
     ra = {}
     for a, b in r.items():
-        "checking and nicifying style table"
         if type(b) == TYPE_EVAL:
             ra[a] = b
-        elif "color" in a and b.strip() != 'none':
-            "parsing color value to 3-tuple"
-            # print "res:", b
-            if b and (type(b) != tuple):
-            # if not b:
-            #    print sl, ftype, tags, zoom, scale, zscale
-            # else:
-                ra[a] = colorparser(b)
-            elif b:
-                ra[a] = b
-        elif any(x in a for x in ("width", "opacity", "offset", "radius", "extrude")):
-            "these things are float's or not in table at all"
-            try:
-                ra[a] = float(b)
-            except ValueError:
-                pass
-        elif "dashes" in a and type(b) != list:
-            "these things are arrays of float's or not in table at all"
-            try:
-                b = b.split(",")
-                b = [float(x) for x in b]
-                ra[a] = b
-            except ValueError:
-                ra[a] = []
         else:
-            ra[a] = b
+            b = get_converter(a)(b)
+            if b is not None:
+                ra[a] = b
     return ra
 
 
+def make_style(r):
+    """
+    Converts a dict from parseDeclaration() into a style: strips keys and
+    values, compiles eval()'s, parses colors and numbers.
+    Returns the style and True if it has eval()'s.
+    """
+    has_evals = False
+    ra = {}
+    for a, b in r.items():
+        a = sys.intern(a.strip())
+        b = b.strip()
+        if a == "casing-width":
+            "josm support"
+            if b[0] == "+":
+                try:
+                    b = str(float(b) / 2)
+                except:
+                    pass
+        if b[:5] == "eval(":
+            b = Eval(b)
+            has_evals = True
+        ra[a] = b
+    return make_nice_style(ra), has_evals
+
+
+class StyleProps:
+    """
+    Properties of all styles of a StyleCascade combined the way prop() of
+    eval() sees them: a property has the value from the last style in the list
+    which has it. Colors are seen as hex strings.
+    """
+
+    def __init__(self):
+        self.positions = {} # property -> index of the style with its value
+        self.values = {}
+
+    def update(self, index, object_id, style):
+        """
+        Takes values of `style` applied to the style at `index` with `object_id`
+        """
+        positions = self.positions
+        values = self.values
+        for key, value in style.items():
+            if positions.get(key, -1) <= index:
+                positions[key] = index
+                values[key] = value
+        if positions.get("object-id", -1) <= index:
+            positions["object-id"] = index
+            values["object-id"] = object_id
+
+    def get(self, key, default=None):
+        value = self.values.get(key, default)
+        if type(value) == Color:
+            return value.hex
+        return value
+
+
+class StyleCascade:
+    """
+    Styles of an object accumulated by StyleChooser.applyStyles(): a list of
+    style dicts, one per subpart, in order of their appearance, and a map
+    object-id -> index in the list for merging.
+
+    Styles are copied on write: a subpart refers to the shared style dict of
+    a chooser until another style overrides it, then it gets its own dict
+    with "object-id".
+
+    A style with "::*" object-id is broadcast: it updates styles of all the
+    subparts and it's kept as a style of its own, new subparts start as its copy.
+    """
+
+    def __init__(self, styles=None):
+        # Given styles are updated in place, a given list gets new subparts too
+        self.styles = [] if styles is None else styles
+        self.object_ids = [style.get("object-id") for style in self.styles]
+        self.owned = [True] * len(self.styles) # False for shared styles
+        self.by_id = {} # object-id -> index in self.styles
+        for i, object_id in enumerate(self.object_ids):
+            self.by_id.setdefault(object_id, i)
+        # Made on first use by eval(), most objects have no evals
+        self.props = None
+
+    def get_props(self):
+        """
+        Returns StyleProps of the cascade, they are kept up to date as styles are added
+        """
+        if self.props is None:
+            self.props = StyleProps()
+            for i, style in enumerate(self.styles):
+                self.props.update(i, self.object_ids[i], style)
+        return self.props
+
+    def own(self, i):
+        """
+        Returns style dict at index `i` which may be changed, copies a shared one
+        """
+        style = self.styles[i]
+        if not self.owned[i]:
+            style = self.styles[i] = style.copy()
+            style["object-id"] = self.object_ids[i]
+            self.owned[i] = True
+        return style
+
+    def get_styles(self):
+        """
+        Returns list of style dicts of the subparts which may be changed
+        """
+        for i in range(len(self.styles)):
+            self.own(i)
+        return self.styles
+
+    def add(self, style, object_id):
+        """
+        Merges style dict of `object_id` subpart into the cascade. The dict
+        may be shared, so it must not be changed afterwards.
+        """
+        if object_id == "::*":
+            for i in range(len(self.styles)):
+                self.own(i).update(style)
+            if object_id not in self.by_id:
+                self.append(style, object_id, False)
+            elif self.props is not None and self.styles:
+                # The last style has the values now
+                self.props.update(len(self.styles) - 1, self.object_ids[-1], style)
+        else:
+            i = self.by_id.get(object_id)
+            if i is not None:
+                self.own(i).update(style)
+                if self.props is not None:
+                    self.props.update(i, object_id, style)
+            else:
+                i = self.by_id.get("::*")
+                if i is None:
+                    self.append(style, object_id, False)
+                else:
+                    x = self.styles[i].copy()
+                    x["object-id"] = object_id
+                    x.update(style)
+                    self.append(x, object_id, True)
+
+    def append(self, style, object_id, owned):
+        self.styles.append(style)
+        self.object_ids.append(object_id)
+        self.owned.append(owned)
+        self.by_id[object_id] = len(self.styles) - 1
+        if self.props is not None:
+            self.props.update(len(self.styles) - 1, object_id, style)
+
+
 class StyleChooser:
     """
     A StyleChooser object is equivalent to one CSS selector+declaration.
@@ -81,16 +212,30 @@ class StyleChooser:
     def __repr__(self):
         return "{(%s) : [%s] }\n" % (self.ruleChains, self.styles)
 
+    __slots__ = ('ruleChains', 'styles', 'scalepair', 'selzooms', 'compatible_types', 'has_evals',
+                 'has_runtime_conditions', 'cached_tags', 'compiled_chains')
+    eval_type = TYPE_EVAL
+
     def __init__(self, scalepair):
         self.ruleChains = []
         self.styles = []
-        self.eval_type = TYPE_EVAL
         self.scalepair = scalepair
         self.selzooms = None
         self.compatible_types = set()
         self.has_evals = False
         self.has_runtime_conditions = False
         self.cached_tags = None
+        self.compiled_chains = None
+
+    def __getstate__(self):
+        # Generated function can't be pickled, it is made again on demand
+        state = dict((name, getattr(self, name)) for name in self.__slots__)
+        state['compiled_chains'] = None
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def extract_tags(self):
         if self.cached_tags is not None:
@@ -106,6 +251,9 @@ class StyleChooser:
                 for v in list(s.values()):
                     if type(v) == self.eval_type:
                         a.update(v.extract_tags())
+            if "*" in a:
+                # eval() reads a tag known only at runtime
+                a = set('*')
         if len(a) == 0:
             a = set('*')
         self.cached_tags = a
@@ -124,8 +272,10 @@ class StyleChooser:
 
         return rule.runtime_conditions
 
-    # TODO: Rename to "applyStyles"
     def updateStyles(self, sl, tags, xscale, zscale, filter_by_runtime_conditions):
+        """
+        List-based wrapper of applyStyles() kept for compatibility
+        """
         # Are any of the ruleChains fulfilled?
         rule_and_object_id = self.testChains(tags)
 
@@ -135,57 +285,45 @@ class StyleChooser:
         rule = rule_and_object_id[0]
         object_id = rule_and_object_id[1]
 
+        cascade = StyleCascade(sl)
+        self.applyStyles(cascade, rule, object_id, tags, xscale, zscale, filter_by_runtime_conditions)
+        return cascade.get_styles()
+
+    def applyStyles(self, cascade, rule, object_id, tags, xscale, zscale, filter_by_runtime_conditions):
+        """
+        Applies styles of the chooser to StyleCascade `cascade` when `rule` has
+        matched tags with `object_id` subpart
+        """
         if (filter_by_runtime_conditions is not None
             and rule.runtime_conditions is not None
             and filter_by_runtime_conditions != rule.runtime_conditions):
-            return sl
+            return cascade
 
+        object_id = str(object_id)
         for r in self.styles:
             if self.has_evals:
                 ra = {}
                 for a, b in r.items():
                     "calculating eval()'s"
                     if type(b) == self.eval_type:
-                        # TODO: Move next block to a separate function
-                        combined_style = {}
-                        for t in sl:
-                            combined_style.update(t)
-                        for p, q in combined_style.items():
-                            if "color" in p:
-                                combined_style[p] = cairo_to_hex(q)
-                        b = b.compute(tags, combined_style, xscale, zscale)
+                        b = b.compute(tags, cascade.get_props(), xscale, zscale)
                     ra[a] = b
-                ra = make_nice_style(ra)
-            else:
-                ra = r.copy()
-
-            ra["object-id"] = str(object_id)
-            hasall = False
-            allinit = {}
-            for x in sl:
-                if x.get("object-id") == "::*":
-                    allinit = x.copy()
-                if ra["object-id"] == "::*":
-                    oid = x.get("object-id")
-                    x.update(ra)
-                    x["object-id"] = oid
-                    if oid == "::*":
-                        hasall = True
-                else:
-                    if x.get("object-id") == ra["object-id"]:
-                        x.update(ra)
-                        break
-            else:
-                if not hasall:
-                    allinit.update(ra)
-                    sl.append(allinit)
+                r = make_nice_style(ra)
 
-        return sl
+            # Shared style of the chooser is referenced, not copied
+            cascade.add(r, object_id)
+
+        return cascade
 
     def testChains(self, tags):
         """
         Tests an object against a chain
         """
+        if Codegen.ENABLED:
+            if self.compiled_chains is None:
+                self.compiled_chains = Codegen.compile_chains(self.ruleChains)
+            return self.compiled_chains(tags)
+
         for r in self.ruleChains:
             tt = r.test(tags)
             if tt:
@@ -204,17 +342,18 @@ class StyleChooser:
         adds into the current ruleChain (starting a new Rule)
         """
         rule = Rule(e)
-        rule.minZoom = float(self.scalepair[0])
-        rule.maxZoom = float(self.scalepair[1])
+        rule.minZoom = int(self.scalepair[0])
+        rule.maxZoom = int(self.scalepair[1])
         self.ruleChains.append(rule)
+        self.compiled_chains = None
 
     def addZoom(self, z):
-        # print "addZoom ", float(z[0]), ", ", float(z[1])
+        # print "addZoom ", int(z[0]), ", ", int(z[1])
         """
         adds into the current ruleChain (existing Rule)
         """
-        self.ruleChains[-1].minZoom = float(z[0])
-        self.ruleChains[-1].maxZoom = float(z[1])
+        self.ruleChains[-1].minZoom = int(z[0])
+        self.ruleChains[-1].maxZoom = int(z[1])
 
     def addCondition(self, c):
         # print "addCondition ", c
@@ -222,6 +361,7 @@ class StyleChooser:
         adds into the current ruleChain (existing Rule)
         """
         self.ruleChains[-1].conditions.append(c)
+        self.compiled_chains = None
 
     def addRuntimeCondition(self, c):
         # print "addRuntimeCondition ", c
@@ -239,6 +379,19 @@ class StyleChooser:
         """
         adds to this.styles
         """
+        rb = []
+        has_evals = False
+        for r in a:
+            ra, ra_has_evals = make_style(r)
+            has_evals = has_evals or ra_has_evals
+            rb.append(ra)
+        self.appendStyles(rb, has_evals)
+
+    def appendStyles(self, styles, has_evals):
+        """
+        adds already made styles to this.styles. Styles may be shared with
+        other choosers and must not be changed.
+        """
         # TODO: move next for-loop to a new method. Don't call it on every style append
         for r in self.ruleChains:
             if not self.selzooms:
@@ -247,23 +400,6 @@ class StyleChooser:
                 self.selzooms[0] = min(self.selzooms[0], r.minZoom)
                 self.selzooms[1] = max(self.selzooms[1], r.maxZoom)
             self.compatible_types.update(r.get_compatible_types())
-        rb = []
-        for r in a:
-            ra = {}
-            for a, b in r.items():
-                a = a.strip()
-                b = b.strip()
-                if a == "casing-width":
-                    "josm support"
-                    if b[0] == "+":
-                        try:
-                            b = str(float(b) / 2)
-                        except:
-                            pass
-                if b[:5] == "eval(":
-                    b = Eval(b)
-                    self.has_evals = True
-                ra[a] = b
-            ra = make_nice_style(ra)
-            rb.append(ra)
-        self.styles = self.styles + rb
+        if has_evals:
+            self.has_evals = True
+        self.styles = self.styles + styles
@@ -18,14 +18,16 @@
 import re
 import os
 import logging
-from .StyleChooser import StyleChooser
+import multiprocessing
+from .StyleChooser import StyleChooser, StyleCascade, make_style
+from .Matcher import BitsetMatcher, ChooserIndex, ConditionBits, TreeMatcher, ZoomIndex
 from .Condition import Condition
+from .StyleCache import StyleCache, ParseUnitCache, file_digest
 
 
 NEEDED_KEYS = set(["width", "casing-width", "casing-width-add", "fill-color", "fill-image", "icon-image", "text", "extrude",
                    "background-image", "background-color", "pattern-image", "shield-color", "symbol-shape"])
 
-# TODO: Unused constant
 WHITESPACE = re.compile(r'\s+ ', re.S | re.X)
 
 COMMENT = re.compile(r'\/\* .*? \*\/ \s* ', re.S | re.X)
@@ -59,6 +61,36 @@ CONDITION_LT      = re.compile(r'\s* ([:\w]+) \s* <  \s* (.+) \s* $', re.S | re.
 CONDITION_LE      = re.compile(r'\s* ([:\w]+) \s* <= \s* (.+) \s* $', re.S | re.X)
 CONDITION_REGEX   = re.compile(r'\s* ([:\w]+) \s* =~\/ \s* (.+) \/ \s* $', re.S | re.X)
 
+# name -> (Condition type, number of groups). In order of precedence.
+CONDITION_TYPES = {
+    'TRUE':    ('true', 1),
+    'invTRUE': ('ne', 1),
+    'FALSE':   ('false', 1),
+    'SET':     ('set', 1),
+    'UNSET':   ('unset', 1),
+    'NE':      ('ne', 2),
+    'LE':      ('<=', 2),
+    'GE':      ('>=', 2),
+    'LT':      ('<', 2),
+    'GT':      ('>', 2),
+    'REGEX':   ('regex', 2),
+    'EQ':      ('eq', 2),
+}
+# All the CONDITION_* alternatives in one regex, the name of the matched one is `lastgroup`
+CONDITION_ANY = re.compile('|'.join(
+    '(?P<%s>(?%s:%s))' % (name, 'i' if regex.flags & re.I else '', regex.pattern)
+    for name, regex in ((name, globals()['CONDITION_' + name]) for name in CONDITION_TYPES)), re.S | re.X)
+
+# Condition text -> Condition
+CONDITIONS_MEMO = {}
+
+# (declaration text, values of used variables) -> ([style], has_evals)
+DECLARATIONS_MEMO = {}
+# Declaration text -> names of used variables
+DECLARATION_VARIABLES_MEMO = {}
+# Text -> split_template(text)
+TEMPLATES_MEMO = {}
+
 ASSIGNMENT_EVAL = re.compile(r"\s* (\S+) \s* \:      \s* eval \s* \( \s* ' (.+?) ' \s* \) \s* $", re.I | re.S | re.X)
 ASSIGNMENT      = re.compile(r'\s* (\S+) \s* \:      \s*          (.+?) \s*                   $', re.S | re.X)
 SET_TAG_EVAL    = re.compile(r"\s* set \s+(\S+)\s* = \s* eval \s* \( \s* ' (.+?) ' \s* \) \s* $", re.I | re.S | re.X)
@@ -66,6 +98,17 @@ SET_TAG         = re.compile(r'\s* set \s+(\S+)\s* = \s*          (.+?) \s*
 SET_TAG_TRUE    = re.compile(r'\s* set \s+(\S+)\s* $', re.I | re.S | re.X)
 EXIT            = re.compile(r'\s* exit \s* $', re.I | re.S | re.X)
 
+# Statements produced by tokenize()
+tERROR = 0
+tCLASS = 1
+tZOOM = 2
+tGROUP = 3
+tCONDITION = 4
+tOBJECT = 5
+tDECLARATION = 6
+tIMPORT = 7
+tVARIABLE_SET = 8
+
 oNONE = 0
 oZOOM = 2
 oGROUP = 3
@@ -100,93 +143,107 @@ class MapCSS():
         self.scalepair = (minscale, maxscale)
         self.choosers = []
         self.choosers_by_type = {}
-        self.choosers_by_type_zoom_tag = {}
-        self.variables = {}
+        self.choosers_by_type_tag = {} # type -> clname -> ZoomIndex, made by build_choosers_tree()
+        self.choosers_index = {} # type -> ChooserIndex, made by build_choosers_tree()
+        # Matches tags against choosers of each type and class, see finalize_choosers_tree()
+        # `matcher_type` is "bitset" for BitsetMatcher, "tree" for TreeMatcher
+        # or None to test choosers one by one
+        self.matcher_type = "bitset"
+        self.matchers = {}
+        self.variables = {} # name -> value with resolved variables
+        self.variable_definitions = {} # name -> index of current definition in variable_graph
+        self.variable_graph = [] # (name, indexes of definitions used in the value)
+        self.used_variable_definitions = set() # indexes of definitions used in declarations
         self.unused_variables = set()
         self.style_loaded = False
 
     def parseZoom(self, s):
         if ZOOM_MINMAX.match(s):
-            return tuple([float(i) for i in ZOOM_MINMAX.match(s).groups()])
+            return tuple([int(i) for i in ZOOM_MINMAX.match(s).groups()])
         elif ZOOM_MIN.match(s):
-            return float(ZOOM_MIN.match(s).groups()[0]), self.maxscale
+            return int(ZOOM_MIN.match(s).groups()[0]), self.maxscale
         elif ZOOM_MAX.match(s):
-            return float(self.minscale), float(ZOOM_MAX.match(s).groups()[0])
+            return int(self.minscale), int(ZOOM_MAX.match(s).groups()[0])
         elif ZOOM_SINGLE.match(s):
-            return float(ZOOM_SINGLE.match(s).groups()[0]), float(ZOOM_SINGLE.match(s).groups()[0])
+            return int(ZOOM_SINGLE.match(s).groups()[0]), int(ZOOM_SINGLE.match(s).groups()[0])
         else:
             # TODO: Should we raise an exception here?
             logging.error("unparsed zoom: %s" % s)
 
     def build_choosers_tree(self, clname, type, cltag):
-        if type not in self.choosers_by_type_zoom_tag:
-            self.choosers_by_type_zoom_tag[type] = {}
-        for zoom in range(self.minscale, self.maxscale + 1):
-            if zoom not in self.choosers_by_type_zoom_tag[type]:
-                self.choosers_by_type_zoom_tag[type][zoom] = {}
-            if clname not in self.choosers_by_type_zoom_tag[type][zoom]:
-                self.choosers_by_type_zoom_tag[type][zoom][clname] = {'arr': [], 'set': set()}
+        if type not in self.choosers_by_type_tag:
+            self.choosers_by_type_tag[type] = {}
+        if clname not in self.choosers_by_type_tag[type]:
+            self.choosers_by_type_tag[type][clname] = ZoomIndex(self.minscale, self.maxscale)
         if type in self.choosers_by_type:
-            for chooser in self.choosers_by_type[type]:
-                chooser_tags = chooser.extract_tags()
-                if '*' in chooser_tags or cltag in chooser_tags:
-                    for zoom in range(int(chooser.selzooms[0]), int(chooser.selzooms[1]) + 1):
-                        if chooser not in self.choosers_by_type_zoom_tag[type][zoom][clname]['set']:
-                            self.choosers_by_type_zoom_tag[type][zoom][clname]['arr'].append(chooser)
-                            self.choosers_by_type_zoom_tag[type][zoom][clname]['set'].add(chooser)
+            if type not in self.choosers_index:
+                self.choosers_index[type] = ChooserIndex(self.choosers_by_type[type])
+            zoom_index = self.choosers_by_type_tag[type][clname]
+            for chooser in self.choosers_index[type].get_choosers(cltag):
+                zoom_index.add(chooser)
 
     def finalize_choosers_tree(self):
-        for ftype in self.choosers_by_type_zoom_tag.keys():
-            for zoom in self.choosers_by_type_zoom_tag[ftype].keys():
-                for clname in self.choosers_by_type_zoom_tag[ftype][zoom].keys():
-                    # Discard unneeded unique set of choosers.
-                    self.choosers_by_type_zoom_tag[ftype][zoom][clname] = self.choosers_by_type_zoom_tag[ftype][zoom][clname]['arr']
-                    for i in range(0, len(self.choosers_by_type_zoom_tag[ftype][zoom][clname])):
-                        chooser = self.choosers_by_type_zoom_tag[ftype][zoom][clname][i]
-                        optimized = StyleChooser(chooser.scalepair)
-                        optimized.styles = chooser.styles
-                        optimized.eval_type = chooser.eval_type
-                        optimized.has_evals = chooser.has_evals
-                        optimized.has_runtime_conditions = chooser.has_runtime_conditions
-                        optimized.selzooms = [zoom, zoom]
-                        optimized.ruleChains = []
-                        for rule in chooser.ruleChains:
-                            # Discard chooser's rules that don't match type or zoom.
-                            if ftype in rule.type_matches and zoom >= rule.minZoom and zoom <= rule.maxZoom:
-                                optimized.ruleChains.append(rule)
-                        self.choosers_by_type_zoom_tag[ftype][zoom][clname][i] = optimized
-
+        for ftype, zoom_indexes in self.choosers_by_type_tag.items():
+            for zoom_index in zoom_indexes.values():
+                # Discard chooser's rules that don't match type or zoom.
+                zoom_index.finalize(ftype)
+
+        self.matchers = {}
+        if self.matcher_type == "bitset":
+            condition_bits = ConditionBits()
+            for ftype, zoom_indexes in self.choosers_by_type_tag.items():
+                self.matchers[ftype] = dict((clname, BitsetMatcher(zoom_index, condition_bits))
+                                            for clname, zoom_index in zoom_indexes.items())
+        elif self.matcher_type == "tree":
+            for ftype, zoom_indexes in self.choosers_by_type_tag.items():
+                self.matchers[ftype] = dict((clname, TreeMatcher(zoom_index))
+                                            for clname, zoom_index in zoom_indexes.items())
+
+    def match_choosers(self, clname, type, tags, zoom):
+        """
+        Returns list of (chooser, rule, object_id) for choosers of clname/type/zoom which match tags
+        """
+        matcher = self.matchers.get(type, {}).get(clname)
+        if matcher is not None:
+            return matcher.match(tags, zoom)
+        matches = []
+        for chooser, rules in self.choosers_by_type_tag[type][clname].get_choosers(zoom):
+            for rule in rules:
+                object_id = rule.test(tags)
+                if object_id:
+                    matches.append((chooser, rule, object_id))
+                    break
+        return matches
 
     def get_runtime_rules(self, clname, type, tags, zoom):
         """
         Returns array of runtime_conditions which are used for clname/type/tags/zoom
         """
         runtime_rules = []
-        if type in self.choosers_by_type_zoom_tag:
-            for chooser in self.choosers_by_type_zoom_tag[type][zoom][clname]:
-                runtime_conditions = chooser.get_runtime_conditions(tags)
-                if runtime_conditions:
-                    runtime_rules.append(runtime_conditions)
+        if type in self.choosers_by_type_tag:
+            for chooser, rule, object_id in self.match_choosers(clname, type, tags, zoom):
+                if chooser.has_runtime_conditions and rule.runtime_conditions:
+                    runtime_rules.append(rule.runtime_conditions)
         return runtime_rules
 
     # TODO: Renamed to `get_styles` because it returns a list of styles for each class `::XXX`
     # Refactoring idea: Maybe return dict with `object-id` as a key
     def get_style(self, clname, type, tags, zoom, xscale, zscale, filter_by_runtime_conditions):
+        cascade = StyleCascade()
+        if type in self.choosers_by_type_tag:
+            for chooser, rule, object_id in self.match_choosers(clname, type, tags, zoom):
+                chooser.applyStyles(cascade, rule, object_id, tags, xscale, zscale, filter_by_runtime_conditions)
         style = []
-        if type in self.choosers_by_type_zoom_tag:
-            for chooser in self.choosers_by_type_zoom_tag[type][zoom][clname]:
-                style = chooser.updateStyles(style, tags, xscale, zscale, filter_by_runtime_conditions)
-        style = [x for x in style if x["object-id"] != "::*"]
-        for x in style:
+        for i, x in enumerate(cascade.styles):
+            if cascade.object_ids[i] == "::*" or NEEDED_KEYS.isdisjoint(x):
+                continue
+            x = cascade.own(i)
             for k, v in [('width', 0), ('casing-width', 0)]:
                 if k in x:
                     if x[k] == v:
                         del x[k]
-        st = []
-        for x in style:
             if not NEEDED_KEYS.isdisjoint(x):
-                st.append(x)
-        style = st
+                style.append(x)
         return style
 
     def get_colors(self):
@@ -202,91 +259,175 @@ class MapCSS():
         r = self.get_style(clname, type, tags, zoom, xscale, zscale, filter_by_runtime_conditions)
         d = olddict
         for x in r:
-            if x.get('object-id', '') not in d:
-                d[x.get('object-id', '')] = {}
-            d[x.get('object-id', '')].update(x)
+            object_id = x.get('object-id', '')
+            if object_id not in d:
+                # Styles made by get_style() are not referenced by anything else
+                d[object_id] = x
+            else:
+                d[object_id].update(x)
         return d
 
-    def subst_variables(self, t):
-        """ Expects an array from parseDeclaration. """
-        for k in t[0]:
-            t[0][k] = VARIABLE.sub(self.get_variable, t[0][k])
-        return t
-
-    def get_variable(self, m):
-        name = m.group()[1:]
-        if name in self.unused_variables:
-            self.unused_variables.remove(name)
-        if not name in self.variables:
-            raise Exception("Variable not found: " + str(format(name)))
-        return self.variables[name] if name in self.variables else m.group()
-
-    def parse(self, css=None, clamp=True, stretch=1000, filename=None, static_tags={}, dynamic_tags=set()):
+    def make_styles(self, decl, t):
+        """
+        Returns styles list and has_evals flag for declaration text `decl`
+        parsed into `t`. Result is shared by all the declarations with the same
+        text and the same values of variables used in it.
+        """
+        names = DECLARATION_VARIABLES_MEMO.get(decl)
+        if names is None:
+            names = {}
+            for v in t.values():
+                names.update(dict.fromkeys(split_template(v)[1]))
+            names = DECLARATION_VARIABLES_MEMO[decl] = tuple(names)
+        self.used_variable_definitions.update(self.get_definitions(names))
+
+        key = (decl, tuple(self.variables[name] for name in names))
+        result = DECLARATIONS_MEMO.get(key)
+        if result is None:
+            style, has_evals = make_style({k: self.expand_variables(v) for k, v in t.items()})
+            result = DECLARATIONS_MEMO[key] = ([style], has_evals)
+        return result
+
+    def set_variable(self, name, value):
+        """
+        Defines variable. Variables used in the value are resolved right away.
+        """
+        definitions = self.get_definitions(split_template(value)[1])
+        self.variables[name] = self.expand_variables(value)
+        self.variable_graph.append((name, definitions))
+        self.variable_definitions[name] = len(self.variable_graph) - 1
+
+    def get_definitions(self, names):
+        """
+        Returns indexes of current definitions of variables in `variable_graph`
+        """
+        try:
+            return tuple(self.variable_definitions[name] for name in names)
+        except KeyError as e:
+            raise Exception("Variable not found: " + str(e.args[0]))
+
+    def expand_variables(self, text):
+        literals, names = split_template(text)
+        if not names:
+            return text
+        parts = [literals[0]]
+        for name, literal in zip(names, literals[1:]):
+            parts.append(self.variables[name])
+            parts.append(literal)
+        return ''.join(parts)
+
+    def find_unused_variables(self):
+        """
+        Returns names of variables whose current definitions are not reachable
+        from declarations in the variables reference graph.
+        """
+        used = set()
+        stack = list(self.used_variable_definitions)
+        while stack:
+            i = stack.pop()
+            if i not in used:
+                used.add(i)
+                stack.extend(self.variable_graph[i][1])
+        return set(name for name, i in self.variable_definitions.items() if i not in used)
+
+    def warn_unused_variables(self):
+        if self.unused_variables:
+            # TODO: Do not print warning here. Instead let libkomwn.komap_mapswithme(...) analyze unused_variables
+            print(f"Warning: Unused variables: {', '.join(self.unused_variables)}")
+
+    def parse(self, css=None, clamp=True, stretch=1000, filename=None, static_tags={}, dynamic_tags=set(), cache_dir=None,
+              unit_cache=None, processes=None):
         """
         Parses MapCSS given as string
+
+        If `cache_dir` is set then parsed style is stored there and reused by next
+        parse() calls while neither the stylesheet and its imports nor parse
+        arguments change.
+
+        `unit_cache` is a ParseUnitCache shared by several parse() calls. Files
+        which were already tokenized by one of these calls are not tokenized again.
+
+        If `processes` is greater than 1 then imported files are read and tokenized
+        in a pool of that many processes before the style is assembled.
         """
         basepath = os.curdir
         if filename:
             basepath = os.path.dirname(filename)
+        files = [] # (filename, content) of all files read during parsing
+        css_digest = None
         if not css:
             with open(filename) as css_file:
                 css = css_file.read()
+            files.append((filename, css))
+        else:
+            css_digest = file_digest(css)
         if not self.style_loaded:
             self.choosers = []
 
-        log = logging.getLogger('mapcss.parser')
+        cache = None
+        # Cached style can't be merged with an already loaded one
+        if cache_dir and not self.variables and not self.choosers_by_type:
+            cache = StyleCache(cache_dir)
+            cache_key = cache.make_key(os.path.abspath(filename) if filename else None, css_digest,
+                                       self.scalepair, clamp, stretch,
+                                       sorted(static_tags.items()), sorted(dynamic_tags))
+            cached = cache.load(cache_key)
+            if cached is not None:
+                (self.choosers, self.choosers_by_type, self.variables, self.variable_definitions,
+                 self.variable_graph, self.used_variable_definitions) = cached
+                self.unused_variables = self.find_unused_variables()
+                self.warn_unused_variables()
+                return
+
         previous = oNONE  # what was the previous CSS word?
         sc = StyleChooser(self.scalepair)  # currently being assembled
 
-        stck = [] # filename, original, remained
-        stck.append([filename, css, css])
+        stck = [] # filename, statements, index of the next statement
+        stck.append([filename, tokenize_unit(filename, css, unit_cache), 0])
+        units = {} # import filename -> (content, statements)
+        if processes and processes > 1:
+            units = tokenize_imports(basepath, stck[0][1], unit_cache, processes)
+        line = 1
         try:
             while (len(stck) > 0):
-                css = stck[-1][1].lstrip() # remained
+                statements = stck[-1][1]
 
                 wasBroken = False
-                while (css):
+                while stck[-1][2] < len(statements):
+                    token, line, value = statements[stck[-1][2]]
+                    stck[-1][2] += 1
+
                     # Class - :motorway, :builtup, :hover
-                    if CLASS.match(css):
+                    if token == tCLASS:
                         if previous == oDECLARATION:
                             self.choosers.append(sc)
                             sc = StyleChooser(self.scalepair)
-                        cond = CLASS.match(css).groups()[0]
-                        log.debug("class found: %s" % (cond))
-                        css = CLASS.sub("", css, 1)
-                        sc.addCondition(Condition('eq', ("::class", cond)))
+                        sc.addCondition(Condition('eq', ("::class", value)))
                         previous = oCONDITION
 
                     ## Not class - !.motorway, !.builtup, !:hover
-                    #elif NOT_CLASS.match(css):
+                    #elif token == tNOT_CLASS:
                         #if (previous == oDECLARATION):
                             #self.choosers.append(sc)
                             #sc = StyleChooser(self.scalepair)
-                        #cond = NOT_CLASS.match(css).groups()[0]
-                        #log.debug("not_class found: %s" % (cond))
-                        #css = NOT_CLASS.sub("", css, 1)
-                        #sc.addCondition(Condition('ne', ("::class", cond)))
+                        #sc.addCondition(Condition('ne', ("::class", value)))
                         #previous = oCONDITION
 
                     # Zoom
-                    elif ZOOM.match(css):
+                    elif token == tZOOM:
                         if (previous != oOBJECT & previous != oCONDITION):
                             sc.newObject()
-                        cond = ZOOM.match(css).groups()[0]
-                        log.debug("zoom found: %s" % (cond))
-                        css = ZOOM.sub("", css, 1)
-                        sc.addZoom(self.parseZoom(cond))
+                        sc.addZoom(self.parseZoom(value))
                         previous = oZOOM
 
                     # Grouping - just a comma
-                    elif GROUP.match(css):
-                        css = GROUP.sub("", css, 1)
+                    elif token == tGROUP:
                         sc.newGroup()
                         had_main_tag = False
                         previous = oGROUP
 
                     # Condition - [highway=primary] or [population>1000]
-                    elif CONDITION.match(css):
+                    elif token == tCONDITION:
                         if (previous == oDECLARATION):
                             self.choosers.append(sc)
                             sc = StyleChooser(self.scalepair)
@@ -294,8 +435,7 @@ class MapCSS():
                         if (previous != oOBJECT) and (previous != oZOOM) and (previous != oCONDITION):
                             sc.newObject()
                             had_main_tag = False
-                        cond = CONDITION.match(css).groups()[0]
-                        c = parseCondition(cond)
+                        cond, c = value
                         tag = c.extract_tag()
                         tag_type = static_tags.get(tag, None)
                         if tag == "*" or tag_type is not None:
@@ -314,69 +454,50 @@ class MapCSS():
                             sc.addRuntimeCondition(c)
                         else:
                             raise Exception("Unknown tag '" + tag + "' in condition " + cond)
-                        css = CONDITION.sub("", css, 1)
                         previous = oCONDITION
 
                     # Object - way, node, relation
-                    elif OBJECT.match(css):
+                    elif token == tOBJECT:
                         if (previous == oDECLARATION):
                             self.choosers.append(sc)
                             sc = StyleChooser(self.scalepair)
-                        obj = OBJECT.match(css).groups()[0]
-                        log.debug("object found: %s" % (obj))
-                        css = OBJECT.sub("", css, 1)
-                        sc.newObject(obj)
+                        sc.newObject(value)
                         had_main_tag = False
                         previous = oOBJECT
 
                     # Declaration - {...}
-                    elif DECLARATION.match(css):
+                    elif token == tDECLARATION:
                         if previous == oDECLARATION or previous == oNONE:
                             raise Exception("Declaration without conditions")
-                        decl = DECLARATION.match(css).groups()[0]
-                        log.debug("declaration found: %s" % (decl))
-                        sc.addStyles(self.subst_variables(parseDeclaration(decl)))
-                        css = DECLARATION.sub("", css, 1)
+                        sc.appendStyles(*self.make_styles(*value))
                         previous = oDECLARATION
 
-                    # CSS comment
-                    elif COMMENT.match(css):
-                        log.debug("comment found")
-                        css = COMMENT.sub("", css, 1)
-
                     # @import("filename.css");
-                    elif IMPORT.match(css):
-                        log.debug("import found")
-                        import_filename = os.path.join(basepath, IMPORT.match(css).groups()[0])
-                        try:
-                            css = IMPORT.sub("", css, 1)
-                            with open(import_filename, "r") as import_file:
-                                import_text = import_file.read()
-                            stck[-1][1] = css # store remained part
-                            stck.append([import_filename, import_text, import_text])
-                            wasBroken = True
-                            break
-                        except IOError as e:
-                            raise Exception("Cannot import file " + import_filename + "\n" + str(e))
+                    elif token == tIMPORT:
+                        import_filename = os.path.join(basepath, value)
+                        if import_filename in units:
+                            import_text, import_statements = units[import_filename]
+                        else:
+                            try:
+                                with open(import_filename, "r") as import_file:
+                                    import_text = import_file.read()
+                            except IOError as e:
+                                raise Exception("Cannot import file " + import_filename + "\n" + str(e))
+                            import_statements = tokenize_unit(import_filename, import_text, unit_cache)
+                        files.append((import_filename, import_text))
+                        stck.append([import_filename, import_statements, 0])
+                        line = 1
+                        wasBroken = True
+                        break
 
                     # Variables
-                    elif VARIABLE_SET.match(css):
-                        name = VARIABLE_SET.match(css).groups()[0]
-                        log.debug("variable set found: %s" % name)
-                        self.variables[name] = VARIABLE_SET.match(css).groups()[1]
-                        self.unused_variables.add( name )
-                        css = VARIABLE_SET.sub("", css, 1)
+                    elif token == tVARIABLE_SET:
+                        self.set_variable(*value)
                         previous = oVARIABLE_SET
 
-                    # Unknown pattern
-                    elif UNKNOWN.match(css):
-                        raise Exception("Unknown construction: " + UNKNOWN.match(css).group())
-
-                    # Must be unreachable
+                    # Syntax error found by tokenize()
                     else:
-                        raise Exception("Unexpected construction: " + css)
-
-                    stck[-1][1] = css # store remained part
+                        raise Exception(value)
 
                 if not wasBroken:
                     stck.pop()
@@ -387,9 +508,6 @@ class MapCSS():
 
         except Exception as e:
             filename = stck[-1][0] # filename
-            css_orig = stck[-1][2] # original
-            css = stck[-1][1] # remained
-            line = css_orig[:-len(css)].count("\n") + 1
             # TODO: Handle filename is None
             msg = str(e) + "\nFile: " + filename + "\nLine: " + str(line)
             # TODO: Print stack trace of original exception `e`
@@ -406,18 +524,22 @@ class MapCSS():
                 zindex = list(zindex)
                 zindex.sort()
                 for chooser in self.choosers:
-                    for stylez in chooser.styles:
+                    for i, stylez in enumerate(chooser.styles):
                         if 'z-index' in stylez:
                             res = zindex.index(float(stylez.get('z-index', 0)))
+                            # Styles are shared between choosers, replace instead of changing
+                            stylez = dict(stylez)
                             if stretch:
                                 stylez['z-index'] = stretch * res / len(zindex)
                             else:
                                 stylez['z-index'] = res
+                            chooser.styles[i] = stylez
         except TypeError:
             # TODO: Better error handling here
             pass
 
         # Group MapCSS styles by object type: 'area', 'line', 'way', 'node'
+        self.choosers_index = {}
         for chooser in self.choosers:
             for t in chooser.compatible_types:
                 if t not in self.choosers_by_type:
@@ -425,77 +547,227 @@ class MapCSS():
                 else:
                     self.choosers_by_type[t].append(chooser)
 
-        if self.unused_variables:
-            # TODO: Do not print warning here. Instead let libkomwn.komap_mapswithme(...) analyze unused_variables
-            print(f"Warning: Unused variables: {', '.join(self.unused_variables)}")
+        if cache is not None:
+            cache.store(cache_key, files, (self.choosers, self.choosers_by_type, self.variables, self.variable_definitions,
+                                           self.variable_graph, self.used_variable_definitions))
+
+        self.unused_variables = self.find_unused_variables()
+
+        self.warn_unused_variables()
+
+def split_template(text):
+    """
+    Splits text into literal parts and names of variables between them, e.g.
+    "@a 10 @b" -> (('', ' 10 ', ''), ('a', 'b'))
+    """
+    template = TEMPLATES_MEMO.get(text)
+    if template is None:
+        parts = VARIABLE.split(text)
+        template = TEMPLATES_MEMO[text] = (tuple(parts[0::2]), tuple(parts[1::2]))
+    return template
+
+
+def tokenize(css):
+    """
+    Splits MapCSS text into a list of (token, line, value) statements
+
+    Statements don't depend on parse() arguments and variables, so the same
+    list may be shared by several parse() calls. A syntax error ends the list
+    with a tERROR statement, parse() reports it when gets to it.
+    """
+    log = logging.getLogger('mapcss.parser')
+    statements = []
+    pos = 0
+    m = WHITESPACE.match(css, pos)
+    if m:
+        pos = m.end()
+    end = len(css)
+    line = 1
+    line_pos = 0
+    try:
+        while (pos < end):
+            line += css.count("\n", line_pos, pos)
+            line_pos = pos
+
+            # Class - :motorway, :builtup, :hover
+            m = CLASS.match(css, pos)
+            if m:
+                cond = m.group(1)
+                log.debug("class found: %s" % (cond))
+                statements.append((tCLASS, line, cond))
+                pos = m.end()
+                continue
+
+            ## Not class - !.motorway, !.builtup, !:hover
+            #m = NOT_CLASS.match(css, pos)
+            #if m:
+                #cond = m.group(1)
+                #log.debug("not_class found: %s" % (cond))
+                #statements.append((tNOT_CLASS, line, cond))
+                #pos = m.end()
+                #continue
+
+            # Zoom
+            m = ZOOM.match(css, pos)
+            if m:
+                cond = m.group(1)
+                log.debug("zoom found: %s" % (cond))
+                statements.append((tZOOM, line, cond))
+                pos = m.end()
+                continue
+
+            # Grouping - just a comma
+            m = GROUP.match(css, pos)
+            if m:
+                statements.append((tGROUP, line, None))
+                pos = m.end()
+                continue
+
+            # Condition - [highway=primary] or [population>1000]
+            m = CONDITION.match(css, pos)
+            if m:
+                cond = m.group(1)
+                statements.append((tCONDITION, line, (cond, parseCondition(cond))))
+                pos = m.end()
+                continue
+
+            # Object - way, node, relation
+            m = OBJECT.match(css, pos)
+            if m:
+                obj = m.group(1)
+                log.debug("object found: %s" % (obj))
+                statements.append((tOBJECT, line, obj))
+                pos = m.end()
+                continue
+
+            # Declaration - {...}
+            m = DECLARATION.match(css, pos)
+            if m:
+                decl = m.group(1)
+                log.debug("declaration found: %s" % (decl))
+                statements.append((tDECLARATION, line, (decl, parseDeclaration(decl)[0])))
+                pos = m.end()
+                continue
+
+            # CSS comment
+            m = COMMENT.match(css, pos)
+            if m:
+                log.debug("comment found")
+                pos = m.end()
+                continue
+
+            # @import("filename.css");
+            m = IMPORT.match(css, pos)
+            if m:
+                log.debug("import found")
+                statements.append((tIMPORT, line, m.group(1)))
+                pos = m.end()
+                continue
+
+            # Variables
+            m = VARIABLE_SET.match(css, pos)
+            if m:
+                name = m.group(1)
+                log.debug("variable set found: %s" % name)
+                statements.append((tVARIABLE_SET, line, (name, m.group(2))))
+                pos = m.end()
+                continue
+
+            # Unknown pattern
+            m = UNKNOWN.match(css, pos)
+            if m:
+                raise Exception("Unknown construction: " + m.group())
+
+            # Must be unreachable
+            raise Exception("Unexpected construction: " + css[pos:])
+
+    except Exception as e:
+        statements.append((tERROR, line, str(e)))
+
+    return statements
+
+
+def tokenize_unit(filename, css, unit_cache):
+    if unit_cache is None or not filename:
+        return tokenize(css)
+    return unit_cache.get(filename, css, tokenize)
+
+
+def tokenize_imports(basepath, statements, unit_cache, processes):
+    """
+    Reads and tokenizes all files reachable through @import from `statements`
+    in a pool of `processes` processes. Files are handled in waves: each wave
+    tokenizes files imported by the previous one.
+
+    Returns dict import filename -> (content, statements). Files which can't
+    be read are skipped, parse() reports them at the place of @import.
+    """
+    units = {}
+    seen = set()
+    wave = [statements]
+    # Don't touch default context, libkomwm sets its start method later
+    context = multiprocessing.get_context(multiprocessing.get_all_start_methods()[0])
+    with context.Pool(processes) as pool:
+        while wave:
+            next_wave = []
+            names = []
+            texts = []
+            for unit_statements in wave:
+                for token, line, value in unit_statements:
+                    if token != tIMPORT:
+                        continue
+                    import_filename = os.path.join(basepath, value)
+                    if import_filename in seen:
+                        continue
+                    seen.add(import_filename)
+                    try:
+                        with open(import_filename, "r") as import_file:
+                            import_text = import_file.read()
+                    except IOError:
+                        continue
+                    cached = unit_cache.find(import_filename, import_text) if unit_cache is not None else None
+                    if cached is not None:
+                        units[import_filename] = (import_text, cached)
+                        next_wave.append(cached)
+                    else:
+                        names.append(import_filename)
+                        texts.append(import_text)
+
+            wave = next_wave
+            for import_filename, import_text, import_statements in zip(names, texts, pool.map(tokenize, texts)):
+                units[import_filename] = (import_text, import_statements)
+                if unit_cache is not None:
+                    unit_cache.add(import_filename, import_text, import_statements)
+                wave.append(import_statements)
+    return units
+
 
 # TODO: move to Condition.py
 def parseCondition(s):
-    log = logging.getLogger('mapcss.parser.condition')
-
-    if CONDITION_TRUE.match(s):
-        a = CONDITION_TRUE.match(s).groups()
-        log.debug("condition true: %s" % (a[0]))
-        return Condition('true', a)
-
-    if CONDITION_invTRUE.match(s):
-        a = CONDITION_invTRUE.match(s).groups()
-        log.debug("condition invtrue: %s" % (a[0]))
-        return Condition('ne', (a[0], "yes"))
-
-    if CONDITION_FALSE.match(s):
-        a = CONDITION_FALSE.match(s).groups()
-        log.debug("condition false: %s" % (a[0]))
-        return Condition('false', a)
-
-    if CONDITION_SET.match(s):
-        a = CONDITION_SET.match(s).groups()
-        log.debug("condition set: %s" % (a))
-        return Condition('set', a)
-
-    if CONDITION_UNSET.match(s):
-        a = CONDITION_UNSET.match(s).groups()
-        log.debug("condition unset: %s" % (a))
-        return Condition('unset', a)
-
-    if CONDITION_NE.match(s):
-        a = CONDITION_NE.match(s).groups()
-        log.debug("condition NE: %s = %s" % (a[0], a[1]))
-        return Condition('ne', a)
-
-    if CONDITION_LE.match(s):
-        a = CONDITION_LE.match(s).groups()
-        log.debug("condition LE: %s <= %s" % (a[0], a[1]))
-        return Condition('<=', a)
-
-    if CONDITION_GE.match(s):
-        a = CONDITION_GE.match(s).groups()
-        log.debug("condition GE: %s >= %s" % (a[0], a[1]))
-        return Condition('>=', a)
-
-    if CONDITION_LT.match(s):
-        a = CONDITION_LT.match(s).groups()
-        log.debug("condition LT: %s < %s" % (a[0], a[1]))
-        return Condition('<', a)
-
-    if CONDITION_GT.match(s):
-        a = CONDITION_GT.match(s).groups()
-        log.debug("condition GT: %s > %s" % (a[0], a[1]))
-        return Condition('>', a)
-
-    if CONDITION_REGEX.match(s):
-        a = CONDITION_REGEX.match(s).groups()
-        log.debug("condition REGEX: %s = %s" % (a[0], a[1]))
-        return Condition('regex', a)
-
-    if CONDITION_EQ.match(s):
-        a = CONDITION_EQ.match(s).groups()
-        log.debug("condition EQ: %s = %s" % (a[0], a[1]))
-        return Condition('eq', a)
-
-    else:
+    """
+    Parses condition text, e.g. `highway=primary`. Returns a Condition shared
+    by all the calls with the same text.
+    """
+    condition = CONDITIONS_MEMO.get(s)
+    if condition is not None:
+        return condition
+
+    m = CONDITION_ANY.match(s)
+    if not m:
         raise Exception("condition UNKNOWN: " + s)
 
+    name = m.lastgroup
+    condType, groups_count = CONDITION_TYPES[name]
+    first = CONDITION_ANY.groupindex[name] + 1
+    a = tuple(m.group(i) for i in range(first, first + groups_count))
+    logging.getLogger('mapcss.parser.condition').debug("condition %s: %s" % (name, a))
+
+    if name == 'invTRUE':
+        a = (a[0], "yes")
+    condition = Condition(condType, a)
+    CONDITIONS_MEMO[s] = condition
+    return condition
+
 
 def parseDeclaration(s):
     """
@@ -185,10 +185,16 @@ values to normalized color names. These eight mappings are as follows:
     Mapping of normalized hexadecimal values to normalized CSS3 color
     names.
 
+The ``*_hex_to_names`` mappings are built on first access.
+
+``css3_names_to_rgb``
+    Mapping of normalized CSS3 color names to 3-tuples of integers.
+
 """
 
 import math
 import re
+from functools import lru_cache
 from hashlib import md5
 
 
@@ -389,13 +395,44 @@ css3_names_to_hex = {
 ######################################################################
 
 
-html4_hex_to_names = _reversedict(html4_names_to_hex)
+# They are built on first use, see _hex_to_names(). css2_hex_to_names
+# is the same dict as html4_hex_to_names.
+
+_HEX_TO_NAMES = {}
+
+
+def _hex_to_names(spec):
+    """
+    Internal helper returning the reverse mapping of ``spec``'s
+    ``*_names_to_hex``, built and cached on first use.
+
+    """
+    if spec == 'css2':
+        spec = 'html4'
+    hex_to_names = _HEX_TO_NAMES.get(spec)
+    if hex_to_names is None:
+        hex_to_names = _HEX_TO_NAMES[spec] = _reversedict(globals()['%s_names_to_hex' % spec])
+    return hex_to_names
 
-css2_hex_to_names = html4_hex_to_names
 
-css21_hex_to_names = _reversedict(css21_names_to_hex)
+def __getattr__(name):
+    """
+    Makes ``html4_hex_to_names`` and the other reverse mappings module
+    attributes built on first access.
 
-css3_hex_to_names = _reversedict(css3_names_to_hex)
+    """
+    if name.endswith('_hex_to_names') and name[:-len('_hex_to_names')] in SUPPORTED_SPECIFICATIONS:
+        return _hex_to_names(name[:-len('_hex_to_names')])
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+######################################################################
+# Precomputed rgb() triplets of CSS3 color names.
+######################################################################
+
+
+css3_names_to_rgb = dict((name, (int(hex_value[1:3], 16), int(hex_value[3:5], 16), int(hex_value[5:7], 16)))
+                         for name, hex_value in css3_names_to_hex.items())
 
 
 ######################################################################
@@ -615,7 +652,7 @@ def hex_to_name(hex_value, spec='css3'):
                                                                                                                              ', '.join(SUPPORTED_SPECIFICATIONS)))
     normalized = normalize_hex(hex_value)
     try:
-        name = globals()['%s_hex_to_names' % spec][normalized]
+        name = _hex_to_names(spec)[normalized]
     except KeyError:
         raise ValueError("'%s' has no defined color name in %s." % (hex_value, spec))
     return name
@@ -841,38 +878,52 @@ def rgb_percent_to_rgb(rgb_percent_triplet):
     return tuple(map(_percent_to_integer, rgb_percent_triplet))
 
 
+######################################################################
+# Conversions of colors in any format with memoization: a style has
+# a few hundred distinct colors, which are converted many times.
+######################################################################
+
+
+COLOR_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=COLOR_CACHE_SIZE)
 def whatever_to_rgb(string):
     """
     Converts CSS3 color or a hex into rgb triplet; hash of string if fails.
     """
     string = string.strip().lower()
+    rgb = css3_names_to_rgb.get(string)
+    if rgb is not None:
+        return rgb
     try:
-        return name_to_rgb(string)
+        return hex_to_rgb(string)
     except ValueError:
         try:
-            return hex_to_rgb(string)
-        except ValueError:
-            try:
-                if string[:3] == "rgb":
-                    return tuple([float(i) for i in string[4:-1].split(",")][0:3])
-            except:
-                return hex_to_rgb("#" + md5(string).hexdigest()[:6])
+            if string[:3] == "rgb":
+                return tuple([float(i) for i in string[4:-1].split(",")][0:3])
+        except:
+            return hex_to_rgb("#" + md5(string).hexdigest()[:6])
 
 
+@lru_cache(maxsize=COLOR_CACHE_SIZE)
 def whatever_to_hex(string):
     if type(string) == tuple:
         return cairo_to_hex(string).upper()
     return rgb_to_hex(whatever_to_rgb(string)).upper()
 
 
+@lru_cache(maxsize=COLOR_CACHE_SIZE)
 def whatever_to_cairo(string):
     a = whatever_to_rgb(string)
     return a[0] / 255., a[1] / 255., a[2] / 255.
 
 
+@lru_cache(maxsize=COLOR_CACHE_SIZE)
 def cairo_to_hex(cairo):
     return rgb_to_hex((cairo[0] * 255., cairo[1] * 255., cairo[2] * 255.))
 
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
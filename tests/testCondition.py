@@ -1,5 +1,6 @@
 import re
 import unittest
+import pickle
 import sys
 from pathlib import Path
 
@@ -7,7 +8,7 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
 
 from mapcss import parseCondition
-from mapcss.Condition import Condition
+from mapcss.Condition import Condition, CONDITIONS_BY_ID, merge_regex_conditions
 
 class ConditionTest(unittest.TestCase):
 
@@ -296,5 +297,44 @@ class ConditionTest(unittest.TestCase):
                 But not in 'unset' rule [!key-with-dash] """
             parseCondition("key-with-dash?")
 
+    def test_parser_numeric_not_a_number(self):
+        cond:Condition = parseCondition("population>many")
+        self.assertEqual(cond.type, ">")
+        self.assertEqual(cond.params, ("population", "many"))
+        self.assertTrue(cond.test({"population": "1"}))
+        self.assertFalse(cond.test({"population": "few"}))
+        self.assertFalse(cond.test({"highway": "secondary"}))
+
+    def test_merge_regex(self):
+        conditions = [parseCondition(c) for c in (
+            "name=~/^A/", "name=~/street$/", "name=~/x*/", "name=~/(ab)\\1/", "ref=~/^M/", "highway=primary")]
+        regex_sets, rest = merge_regex_conditions(conditions)
+        self.assertEqual(len(regex_sets), 1)
+        self.assertEqual(regex_sets[0].key, "name")
+        self.assertEqual(regex_sets[0].conditions, tuple(conditions[:3]))
+        # Patterns with groups and single regex on a key are not merged
+        self.assertEqual(rest, conditions[3:])
+
+        for value in ("Abbey street", "a", "Main Street", "abab", ""):
+            self.assertEqual(regex_sets[0].test(value), [c for c in conditions[:3] if c.test({"name": value})])
+
+    def test_parser_memo(self):
+        cond:Condition = parseCondition("highway=primary")
+        self.assertIs(parseCondition("highway=primary"), cond)
+        # Conditions are interned by type and params
+        self.assertIs(parseCondition("highway = primary"), cond)
+        self.assertIs(Condition("eq", ["highway", "primary"]), cond)
+        self.assertIsNot(parseCondition("highway=secondary"), cond)
+        self.assertNotEqual(parseCondition("highway=secondary").id, cond.id)
+        self.assertIs(CONDITIONS_BY_ID[cond.id], cond)
+
+        with self.assertRaises(AttributeError):
+            cond.params = ("highway", "secondary")
+        self.assertEqual(cond.params, ("highway", "primary"))
+
+        cond = pickle.loads(pickle.dumps(parseCondition("name=~/^A.+/")))
+        self.assertIs(cond, Condition("regex", ("name", "^A.+")))
+        self.assertTrue(cond.test({"name": "abc"}))
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,12 @@
 import unittest
 import sys
+from unittest import mock
 from pathlib import Path
 
 # Add `src` directory to the import paths
 sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
 
+from mapcss import Eval as EvalModule
 from mapcss.Eval import Eval
 
 class EvalTest(unittest.TestCase):
@@ -120,5 +122,83 @@ class EvalTest(unittest.TestCase):
         self.assertEqual(a.compute({"building:levels": "3"}), "9")
         self.assertSetEqual(a.extract_tags(), {"height", "building:levels"})
 
+    def test_eval_operators(self):
+        a = Eval("""eval( cond(num(tag("lanes")) >= 2 and not boolean(tag("oneway")), -num(tag("lanes")) % 3, 1 if tag("lanes") else 0) )""")
+        self.assertEqual(a.compute({"lanes": "4"}), "2")
+        self.assertEqual(a.compute({"lanes": "4", "oneway": "yes"}), "1")
+        self.assertEqual(a.compute({}), "0")
+
+    def test_eval_not_allowed(self):
+        for expr in ("""eval( __import__("os").getcwd() )""",
+                     """eval( tag("name").upper() )""",
+                     """eval( len(tag("name")) )""",
+                     """eval( tag("name", "default") )""",
+                     """eval( [tag("name")][0] )""",
+                     """eval( name )"""):
+            a = Eval(expr)
+            self.assertEqual(a.compute({"name": "A"}), "", expr)
+
+        with self.assertLogs(EvalModule.logger, "WARNING") as logs:
+            Eval("""eval( __import__("os").getcwd() )""")
+            Eval("""eval( len(tag("name")) )""")
+            Eval("""eval( tag("name", "default") )""")
+            Eval("""eval( name )""")
+        self.assertEqual([output.split(": ", 1)[-1] for output in logs.output],
+                         ["Unknown function: Attribute", "Unknown function: len",
+                          "Wrong arguments of tag", "Not allowed: Name"])
+
+    def test_eval_shared_function(self):
+        a = Eval("""eval( num(tag("lanes")) + 2 )""")
+        b = Eval("""eval(num(tag("lanes")) + 2)""")
+        self.assertIs(a.function, b.function)
+        # Syntax errors are computed as 0
+        self.assertEqual(Eval("""eval( num(tag("lanes") )""").compute({"lanes": "4"}), "0")
+
+    def test_eval_extract_dependencies(self):
+        # Tags of all cond() branches are found
+        a = Eval("""eval( cond(boolean(tag("oneway")), num(tag("lanes")), metric(prop("width")) + num(prop("casing-width"))) )""")
+        self.assertSetEqual(a.extract_tags(), {"oneway", "lanes"})
+        self.assertSetEqual(a.extract_props(), {"width", "casing-width"})
+        self.assertFalse(a.has_dynamic_tags or a.has_dynamic_props)
+
+        a = Eval("""eval( tag(prop("key")) )""")
+        self.assertSetEqual(a.extract_tags(), {"*"})
+        self.assertSetEqual(a.extract_props(), {"key"})
+        self.assertTrue(a.has_dynamic_tags)
+        self.assertFalse(a.has_dynamic_props)
+
+        a = Eval("""eval( prop(cond(boolean(tag("building")), "height", "width")) )""")
+        self.assertSetEqual(a.extract_tags(), {"building"})
+        self.assertSetEqual(a.extract_props(), {"*"})
+
+        # Nothing is read by invalid expressions
+        self.assertSetEqual(Eval("""eval( len(tag("name")) )""").extract_tags(), set())
+
+    def test_eval_results_memo(self):
+        a = Eval("""eval( metric(num(tag("lanes")) * 2 + num(prop("width"))) )""")
+        self.assertEqual((a.tags, a.props), (("lanes",), ("width",)))
+        with mock.patch.object(a, 'function', wraps=a.function) as function:
+            self.assertEqual(a.compute({"lanes": "2", "name": "A"}, {"width": 1.0}), "5")
+            # Other tags and props don't matter
+            self.assertEqual(a.compute({"lanes": "2", "name": "B"}, {"width": 1.0, "color": "red"}), "5")
+            self.assertEqual(function.call_count, 1)
+            self.assertEqual(a.compute({"lanes": "3"}, {"width": 1.0}), "7")
+            self.assertEqual(a.compute({"lanes": "2"}, {"width": 1.0}, xscale=2), "10")
+            self.assertEqual(function.call_count, 3)
+
+        # Tag name is known only at runtime
+        b = Eval("""eval( tag(prop("key")) )""")
+        self.assertTrue(b.has_dynamic_tags)
+        self.assertEqual(b.compute({"lanes": "2"}, {"key": "lanes"}), "2")
+
+    def test_eval_results_memo_size(self):
+        a = Eval("""eval( num(tag("lanes")) + 1 )""")
+        with mock.patch.object(EvalModule, 'RESULTS_MEMO_SIZE', 2):
+            EvalModule.RESULTS_MEMO.clear()
+            for lanes in ("1", "2", "1", "3"):
+                a.compute({"lanes": lanes})
+            # "2" is the least recently used one
+            self.assertEqual([key[1] for key in EvalModule.RESULTS_MEMO], [("1",), ("3",)])
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,13 @@
 import unittest
 import sys
+import tempfile
 from pathlib import Path
 
 # Add `src` directory to the import paths
 sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
 
 from mapcss import parseDeclaration, MapCSS
+from mapcss.Properties import parse_color
 
 
 class MapCSSTest(unittest.TestCase):
@@ -49,6 +51,39 @@ class MapCSSTest(unittest.TestCase):
             "wave_length": "25"
         })
 
+    def test_parse_variables_references(self):
+        parser = MapCSS()
+        parser.parse("""
+@base: #FF0000;
+@road: @base;
+@unused_road: @road;
+@width: 2;
+@width: 3;
+@casing: @width;
+line|z10-[highway=primary]
+{color: @road; width: @width;}
+""", static_tags={"highway": True})
+        self.assertEqual(parser.variables["road"], "#FF0000")
+        self.assertEqual(parser.variables["unused_road"], "#FF0000")
+        self.assertEqual(parser.variables["casing"], "3")
+        self.assertEqual(parser.choosers[0].styles[0], {"color": parse_color("#ff0000"), "width": 3.0})
+        # `base` is used through `road`, `casing` is not used itself
+        self.assertEqual(parser.unused_variables, {"unused_road", "casing"})
+
+        # Redefined variable is unused if its last definition is unused
+        parser = MapCSS()
+        parser.parse("""
+@width: 2;
+line|z10-[highway=primary]
+{width: @width;}
+@width: 3;
+""", static_tags={"highway": True})
+        self.assertEqual(parser.unused_variables, {"width"})
+
+        with self.assertRaises(Exception) as context:
+            MapCSS().parse("@road: @missing;", filename="style.mapcss")
+        self.assertIn("Variable not found: missing", str(context.exception))
+
     def test_parse_colors(self):
         parser = MapCSS()
         parser.parse("""
@@ -69,12 +104,115 @@ class MapCSSTest(unittest.TestCase):
 
         colors = parser.get_colors()
         self.assertEqual(colors, {
-            "GuiText-color": (1.0, 1.0, 1.0),
+            "GuiText-color": parse_color("#ffffff"),
             "GuiText-opacity": 0.7,
-            "Route-color": (0.0, 0.0, 1.0),
+            "Route-color": parse_color("#0000ff"),
             "Route-opacity": 0.5,
         })
 
+    def test_parse_error_line(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            main = Path(tmpdir) / 'main.mapcss'
+            main.write_text("""/* comment */
+@import("include.mapcss");
+@color: #FFFFFF;
+""")
+            include = Path(tmpdir) / 'include.mapcss'
+            include.write_text("""
+way|z10-::*
+{
+  linejoin: round;
+}
+
+way|z12- ^broken
+{
+  width: 1;
+}
+""")
+            parser = MapCSS()
+            with self.assertRaises(Exception) as context:
+                parser.parse(filename=str(main))
+
+            message = str(context.exception)
+            self.assertIn("Unknown construction: ^broken", message)
+            self.assertIn("File: " + str(include), message)
+            self.assertTrue(message.endswith("Line: 7"))
+
+    def test_parse_parallel_imports(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            (tmpdir / 'main.mapcss').write_text("""
+@import("colors.mapcss");
+@import("roads.mapcss");
+@import("buildings.mapcss");
+""")
+            (tmpdir / 'colors.mapcss').write_text("""
+@road: #FF0000;
+""")
+            (tmpdir / 'roads.mapcss').write_text("""
+@import("primary.mapcss");
+line|z10-[highway=secondary]
+{color: @road; width: 1;}
+""")
+            (tmpdir / 'primary.mapcss').write_text("""
+@road: #00FF00;
+line|z10-[highway=primary]
+{color: @road; width: 2;}
+""")
+            (tmpdir / 'buildings.mapcss').write_text("""
+line|z10-[highway=primary]
+{width: 3;}
+""")
+            static_tags = {"highway": True}
+
+            serial = MapCSS()
+            serial.parse(filename=str(tmpdir / 'main.mapcss'), static_tags=static_tags)
+            parallel = MapCSS()
+            parallel.parse(filename=str(tmpdir / 'main.mapcss'), static_tags=static_tags, processes=2)
+
+            self.assertEqual(len(parallel.choosers), 3)
+            self.assertEqual(repr(parallel.choosers), repr(serial.choosers))
+            self.assertEqual(parallel.choosers[1].styles[0]["color"], parse_color("#00ff00"))
+            self.assertEqual(parallel.variables, serial.variables)
+
+            # Errors are still reported at the place of @import
+            (tmpdir / 'buildings.mapcss').unlink()
+            with self.assertRaises(Exception) as context:
+                MapCSS().parse(filename=str(tmpdir / 'main.mapcss'), static_tags=static_tags, processes=2)
+            self.assertIn("Cannot import file", str(context.exception))
+            self.assertTrue(str(context.exception).endswith("Line: 4"))
+
+    def test_parse_shared_declarations(self):
+        css = """
+line|z10-[highway=primary]
+{color: @road; width: 2; z-index: 5;}
+line|z10-[highway=secondary]
+{color: @road; width: 2; z-index: 5;}
+line|z10-[highway=tertiary]
+{color: @other; width: 2; z-index: 5;}
+"""
+        static_tags = {"highway": True}
+        light = MapCSS()
+        light.parse("@road: #FFFFFF;\n@other: #FFFFFF;\n@unused: #000000;" + css, static_tags=static_tags, clamp=False)
+        styles = [chooser.styles[0] for chooser in light.choosers]
+        self.assertIs(styles[0], styles[1])
+        self.assertIsNot(styles[0], styles[2])
+        self.assertEqual(styles[0], styles[2])
+        self.assertEqual(light.unused_variables, {"unused"})
+
+        dark = MapCSS()
+        dark.parse("@road: #000000;\n@other: #000000;" + css, static_tags=static_tags, clamp=False)
+        self.assertEqual(dark.choosers[0].styles[0]["color"], parse_color("#000000"))
+        self.assertEqual(light.choosers[0].styles[0]["color"], parse_color("#ffffff"))
+        self.assertEqual(dark.unused_variables, set())
+
+        # Clamping z-index doesn't change shared styles
+        clamped = MapCSS()
+        clamped.parse("@road: #FFFFFF;\n@other: #FFFFFF;\n@unused: #000000;" + css, static_tags=static_tags, stretch=10)
+        self.assertEqual(clamped.choosers[0].styles[0]["z-index"], 0)
+        self.assertEqual(clamped.choosers[1].styles[0]["z-index"], 0)
+        self.assertEqual(styles[0]["z-index"], "5")
+
     def test_parse_basic_chooser(self):
         parser = MapCSS()
         static_tags = {"tourism": True, "office": True,
@@ -209,14 +347,14 @@ colors {
         # Check that colors from mapcss parsed correctly
         colors = parser.get_colors()
         self.assertEqual(colors, {
-            "GuiText-color": (1.0, 1.0, 1.0),
+            "GuiText-color": parse_color("#ffffff"),
             "GuiText-opacity": 0.7,
-            "MyPositionAccuracy-color": (1.0, 1.0, 1.0),
+            "MyPositionAccuracy-color": parse_color("#ffffff"),
             "MyPositionAccuracy-opacity": 0.06,
-            "Selection-color": (1.0, 1.0, 1.0),
+            "Selection-color": parse_color("#ffffff"),
             "Selection-opacity": 0.64,
-            "Route-color": (0.0, 0.0, 1.0),
-            "RouteOutline-color": (0.0, 1.0, 1.0)
+            "Route-color": parse_color("#0000ff"),
+            "RouteOutline-color": parse_color("#00ffff")
         })
 
     def test_parser_choosers_tree(self):
@@ -266,7 +404,7 @@ area|z17-[office=lawyer]
         self.assertEqual(styles18[0], {'object-id': '::default',
             'font-size': '11',
             'text': 'name',
-            'text-color': (0, 0, 16*3/255),
+            'text-color': parse_color("#000030"),
             'text-offset': 1.0,
             'icon-image': 'lawyer-m.svg'})
 
@@ -278,7 +416,7 @@ area|z17-[office=lawyer]
         self.assertEqual(styles17[0], {'object-id': '::default',
             'font-size': '10',
             'text': 'name',
-            'text-color': (68/255, 68/255, 68/255),
+            'text-color': parse_color("#444444"),
             'text-offset': 1.0,
             'icon-image': 'lawyer-m.svg'})
 
@@ -338,9 +476,9 @@ line|z12-13[highway=tertiary]
         self.assertEqual(len(styles10), 1),
         self.assertEqual(styles10[0], {'object-id': '::shield',
             'shield-font-size': '9',
-            'shield-text-color': (0.0, 0.0, 0.0),
+            'shield-text-color': parse_color("#000000"),
             'shield-text-halo-radius': 0.0,
-            'shield-color': (1.0, 1.0, 1.0),
+            'shield-color': parse_color("#ffffff"),
             'shield-outline-radius': 1.0})
 
         # Pick style for zoom = 15. Expecting two `object-id` values: '::shield' and '::default'
@@ -350,15 +488,36 @@ line|z12-13[highway=tertiary]
         self.assertEqual(len(styles15), 2),
         self.assertEqual(styles15[0], {'object-id': '::shield',
             'shield-font-size': '9',
-            'shield-text-color': (0.0, 0.0, 0.0),
+            'shield-text-color': parse_color("#000000"),
             'shield-text-halo-radius': 0.0,
-            'shield-color': (1.0, 1.0, 1.0),
+            'shield-color': parse_color("#ffffff"),
             'shield-outline-radius': 1.0})
         self.assertEqual(styles15[1], {'object-id': '::default',
             'text': 'name',
-            'text-color': (51/255, 51/255, 51/255),
+            'text-color': parse_color("#333333"),
             'text-halo-opacity': 0.8,
             'text-halo-radius': 1.0})
 
+    def test_get_style_dict_doesnt_change_choosers(self):
+        parser = MapCSS()
+        parser.parse("""
+line|z10-[highway=primary] { width: 0; casing-width: 1; }
+line|z10-[highway=primary]::* { linecap: round; }
+area|z10-[highway=primary] { width: 2; }
+""", static_tags={"highway": True})
+        for ftype in ("line", "area"):
+            parser.build_choosers_tree("highway", ftype, "highway")
+        parser.finalize_choosers_tree()
+        choosers = repr(parser.choosers)
+
+        tags = {"highway": "primary"}
+        for i in range(2):
+            zstyle = parser.get_style_dict("highway", "line", tags, 10, olddict={})
+            zstyle = parser.get_style_dict("highway", "area", tags, 10, olddict=zstyle)
+            self.assertEqual(zstyle, {"::default": {"width": 2.0, "casing-width": 1.0, "linecap": "round",
+                                                    "object-id": "::default"}})
+            zstyle["::default"]["casing-width"] = 5.0
+            self.assertEqual(repr(parser.choosers), choosers)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,223 @@
+import unittest
+import sys
+from unittest import mock
+from pathlib import Path
+
+# Add `src` directory to the import paths
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+from mapcss import MapCSS
+from mapcss.Matcher import BitsetMatcher, ChooserIndex, TreeMatcher
+
+
+class BitsetMatcherTest(unittest.TestCase):
+    def parse(self, matcher_type):
+        parser = MapCSS(0, 19)
+        parser.matcher_type = matcher_type
+        parser.parse("""
+line|z10-[highway=primary]
+{color: #FF0000; width: 2;}
+line|z12-[highway=primary][bridge?],
+line|z12-[highway=primary][tunnel?]::tunnel
+{color: #00FF00; width: 3;}
+line|z14-[highway]::*
+{linecap: round;}
+line|z15-[highway][!name]
+{width: 4;}
+line|z16-[lanes>=3]
+{width: 5;}
+line|z13-[highway][name=~/^a/],
+line|z13-[highway][name=~/road$/]::road
+{text: name;}
+""", static_tags={"highway": True, "bridge": False, "tunnel": False, "name": False, "lanes": False}, clamp=False)
+        parser.build_choosers_tree("highway-primary", "line", "highway")
+        parser.finalize_choosers_tree()
+        return parser
+
+    def test_same_as_chooser_tests(self):
+        self.check_same_as_chooser_tests("bitset", BitsetMatcher)
+
+    def test_tree_same_as_chooser_tests(self):
+        self.check_same_as_chooser_tests("tree", TreeMatcher)
+
+    def check_same_as_chooser_tests(self, matcher_type, matcher_class):
+        bitset = self.parse(matcher_type)
+        plain = self.parse(None)
+        self.assertIsInstance(bitset.matchers["line"]["highway-primary"], matcher_class)
+        self.assertEqual(plain.matchers, {})
+
+        all_tags = [
+            {"highway": "primary"},
+            {"highway": "primary", "bridge": "yes"},
+            {"highway": "primary", "tunnel": "yes", "name": "A", "lanes": "4"},
+            {"highway": "primary", "tunnel": "no", "lanes": "2"},
+            {"highway": "secondary"},
+            {"highway": "primary", "name": "Abbey road"},
+            {"highway": "primary", "name": "Main road"},
+        ]
+        for tags in all_tags:
+            for zoom in range(0, 20):
+                self.assertEqual(bitset.get_style("highway-primary", "line", tags, zoom, 1, 1, None),
+                                 plain.get_style("highway-primary", "line", tags, zoom, 1, 1, None))
+                matched = [(rule, object_id) for chooser, rule, object_id
+                           in bitset.match_choosers("highway-primary", "line", tags, zoom)]
+                expected = []
+                for chooser in plain.choosers_index["line"].get_choosers("highway"):
+                    for rule in chooser.ruleChains:
+                        if "line" in rule.type_matches and rule.minZoom <= zoom <= rule.maxZoom and rule.test(tags):
+                            expected.append((rule, rule.test(tags)))
+                            break
+                self.assertEqual([repr(m) for m in matched], [repr(m) for m in expected])
+                self.assertEqual(repr(plain.match_choosers("highway-primary", "line", tags, zoom)),
+                                 repr(bitset.match_choosers("highway-primary", "line", tags, zoom)))
+
+        style = bitset.get_style("highway-primary", "line", {"highway": "primary", "tunnel": "yes"}, 16, 1, 1, None)
+        self.assertEqual([s["object-id"] for s in style], ["::default", "::tunnel"])
+        self.assertEqual(style[1]["width"], 3.0)
+        self.assertEqual(style[1]["linecap"], "round")
+
+    def test_conditions_tested_once(self):
+        parser = MapCSS(0, 19)
+        parser.parse("""
+line|z10-[highway=primary],
+area|z10-[highway=primary]
+{width: 2;}
+line|z12-[highway=primary][bridge?]
+{width: 3;}
+""", static_tags={"highway": True, "bridge": False}, clamp=False)
+        for ftype in ("line", "area"):
+            parser.build_choosers_tree("highway-primary", ftype, "highway")
+        parser.finalize_choosers_tree()
+
+        line_matcher = parser.matchers["line"]["highway-primary"]
+        area_matcher = parser.matchers["area"]["highway-primary"]
+        self.assertIs(line_matcher.condition_bits, area_matcher.condition_bits)
+
+        tags = {"highway": "primary", "bridge": "yes"}
+        with mock.patch.object(area_matcher, 'evaluate', wraps=area_matcher.evaluate) as evaluate:
+            self.assertEqual(len(parser.get_style("highway-primary", "line", tags, 15, 1, 1, None)), 1)
+            self.assertEqual(len(parser.get_style("highway-primary", "area", tags, 15, 1, 1, None)), 1)
+            # All conditions of area choosers are already tested for line ones
+            self.assertFalse(evaluate.called)
+
+            tags = {"highway": "primary"}
+            self.assertEqual(len(parser.get_style("highway-primary", "area", tags, 15, 1, 1, None)), 1)
+            self.assertTrue(evaluate.called)
+            self.assertEqual(parser.get_style("highway-primary", "line", tags, 15, 1, 1, None)[0]["width"], 2.0)
+
+    def test_condition_bits_per_style(self):
+        # Conditions interned by other styles mustn't widen the masks
+        MapCSS(0, 19).parse("way|z1-[amenity=bench][name]{width: 1;}",
+                            static_tags={"amenity": True, "name": False}, clamp=False)
+        parser = self.parse("bitset")
+        condition_bits = parser.matchers["line"]["highway-primary"].condition_bits
+        bits = sorted(condition_bits.bit_by_condition.values())
+        self.assertEqual(bits, [1 << i for i in range(len(condition_bits.conditions))])
+        for condition, bit in condition_bits.bit_by_condition.items():
+            self.assertIs(condition_bits.conditions[bit.bit_length() - 1], condition)
+
+    def test_tree_branches(self):
+        parser = MapCSS(0, 19)
+        parser.matcher_type = "tree"
+        parser.parse("""
+line|z10-[highway=primary]
+{width: 1;}
+line|z10-[highway=secondary][bridge?]
+{width: 2;}
+line|z10-[highway=primary][bridge?]
+{width: 3;}
+line|z10-[highway=secondary]
+{width: 4;}
+line|z10-[highway]
+{width: 5;}
+line|z10-[highway=primary][!name]
+{width: 6;}
+""", static_tags={"highway": True, "bridge": False, "name": False}, clamp=False)
+        parser.build_choosers_tree("highway", "line", "highway")
+        parser.finalize_choosers_tree()
+
+        matcher = parser.matchers["line"]["highway"]
+        choosers, tree = matcher.lists[matcher.list_by_zoom[15]]
+        key, children, other = tree
+        self.assertEqual(key, "highway")
+        self.assertEqual(sorted(children), ["primary", "secondary"])
+
+        def widths(tags):
+            return [style["width"] for style in parser.get_style("highway", "line", tags, 15, 1, 1, None)]
+        self.assertEqual(widths({"highway": "primary", "bridge": "yes"}), [6.0])
+        self.assertEqual([chooser.styles[0]["width"] for chooser, rule, subpart
+                          in matcher.match({"highway": "primary", "bridge": "yes"}, 15)],
+                         [1.0, 3.0, 5.0, 6.0])
+        self.assertEqual([chooser.styles[0]["width"] for chooser, rule, subpart
+                          in matcher.match({"highway": "secondary", "name": "A"}, 15)],
+                         [4.0, 5.0])
+        self.assertEqual(matcher.match({"railway": "rail"}, 15), [])
+
+    def test_zoom_index(self):
+        parser = MapCSS(0, 19)
+        parser.parse("""
+line|z10-[highway=primary],
+area|z12-14[highway=primary]
+{width: 1;}
+line|z8-11[highway=primary]::casing,
+line|z13-[highway=primary][bridge?]
+{width: 2;}
+node|z3-[highway=primary]
+{width: 3;}
+""", static_tags={"highway": True, "bridge": False}, clamp=False)
+        for ftype in ("line", "area"):
+            parser.build_choosers_tree("highway", ftype, "highway")
+        parser.finalize_choosers_tree()
+
+        zoom_index = parser.choosers_by_type_tag["line"]["highway"]
+        choosers = parser.choosers
+        # Each chooser is stored once with a mask of its zooms
+        self.assertEqual([entry[0] for entry in zoom_index.entries], choosers[:2])
+        self.assertEqual(zoom_index.entries[0][1], (1 << 20) - (1 << 10))
+        self.assertEqual(zoom_index.entries[1][1], (1 << 20) - (1 << 8))
+
+        rules = choosers[0].ruleChains + choosers[1].ruleChains
+        self.assertEqual(zoom_index.get_choosers(5), [])
+        self.assertEqual(zoom_index.get_choosers(9), [(choosers[1], (rules[2],))])
+        self.assertEqual(zoom_index.get_choosers(11), [(choosers[0], (rules[0],)), (choosers[1], (rules[2],))])
+        self.assertEqual(zoom_index.get_choosers(12), [(choosers[0], (rules[0],)), (choosers[1], ())])
+        self.assertEqual(zoom_index.get_choosers(15), [(choosers[0], (rules[0],)), (choosers[1], (rules[3],))])
+
+        # Zooms with the same choosers and rules share a list
+        lists, list_by_zoom = zoom_index.get_lists()
+        self.assertEqual(len(lists), 5)
+        self.assertEqual(set(list_by_zoom), set(range(0, 20)))
+        self.assertEqual([list_by_zoom[zoom] for zoom in (0, 7, 8, 9, 10, 11, 12, 13, 19)], [0, 0, 1, 1, 2, 2, 3, 4, 4])
+        self.assertEqual(lists[list_by_zoom[15]], zoom_index.get_choosers(15))
+
+        # Line rules apply to areas too
+        area_index = parser.choosers_by_type_tag["area"]["highway"]
+        self.assertEqual(area_index.get_choosers(9), [(choosers[1], (rules[2],))])
+        self.assertEqual(area_index.get_choosers(13), [(choosers[0], (rules[0], rules[1])), (choosers[1], (rules[3],))])
+
+    def test_chooser_index(self):
+        parser = MapCSS(0, 19)
+        parser.parse("""
+line|z10-[highway=primary]
+{width: 1;}
+line|z10-[railway=rail]
+{width: 2;}
+line|z10-[name=~/^A/]
+{width: 3;}
+line|z10-[highway][bridge?]
+{width: 4;}
+line|z10-[waterway]
+{width: eval(num(tag("highway")) + 1);}
+line|z10-[railway]
+{width: eval(num(tag(prop("key"))) + 1);}
+""", static_tags={"highway": True, "railway": True, "waterway": True, "bridge": False}, clamp=False)
+        index = ChooserIndex(parser.choosers_by_type["line"])
+        choosers = parser.choosers
+        self.assertEqual(index.get_choosers("highway"), [choosers[0], choosers[2], choosers[3], choosers[4], choosers[5]])
+        self.assertEqual(index.get_choosers("railway"), [choosers[1], choosers[2], choosers[5]])
+        # Tag read by the last eval() is known only at runtime
+        self.assertEqual(index.get_choosers("amenity"), [choosers[2], choosers[5]])
+
+
+if __name__ == '__main__':
+    unittest.main()
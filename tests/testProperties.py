@@ -0,0 +1,77 @@
+import unittest
+import pickle
+import sys
+from pathlib import Path
+
+# Add `src` directory to the import paths
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+from mapcss.Properties import PROPERTIES, GUESSED_PROPERTIES, Color, get_converter, parse_color, to_color, to_float
+
+
+class PropertiesTest(unittest.TestCase):
+    def test_known_properties(self):
+        self.assertIs(get_converter("fill-color"), to_color)
+        self.assertIs(get_converter("casing-width"), to_float)
+        self.assertEqual(get_converter("color")("#FF0000"), parse_color("#ff0000"))
+        self.assertEqual(get_converter("color")("none"), "none")
+        color = parse_color("#ff0000")
+        self.assertIs(get_converter("color")(color), color)
+        self.assertIsNone(get_converter("color")(""))
+        self.assertEqual(get_converter("width")("1.5"), 1.5)
+        self.assertIsNone(get_converter("width")("wide"))
+        self.assertEqual(get_converter("dashes")("1,2.5"), [1.0, 2.5])
+        self.assertEqual(get_converter("dashes")("1,x"), [])
+        self.assertEqual(get_converter("linecap")("round"), "round")
+        self.assertEqual(get_converter("z-index")("10"), "10")
+
+    def test_unknown_properties(self):
+        self.assertNotIn("GuiText-color", PROPERTIES)
+        converter = get_converter("GuiText-color")
+        self.assertIs(GUESSED_PROPERTIES["GuiText-color"], converter)
+        self.assertIs(get_converter("GuiText-color"), converter)
+        self.assertEqual(converter("#00FF00"), parse_color("#00ff00"))
+        self.assertEqual(get_converter("arrow-opacity")("0.5"), 0.5)
+        self.assertEqual(get_converter("arrow-dashes")("3,3"), [3.0, 3.0])
+        self.assertEqual(get_converter("arrow-image")("arrow.svg"), "arrow.svg")
+
+    def test_color(self):
+        color = parse_color("#FF8000")
+        self.assertIsInstance(color, Color)
+        self.assertIs(parse_color("#FF8000"), color)
+        self.assertEqual(color, 0xFF8000)
+        self.assertEqual(color.hex, "#ff8000")
+        self.assertEqual(str(color), "#ff8000")
+        self.assertEqual(repr(color), "Color('#ff8000')")
+        self.assertEqual(parse_color("orange"), 0xFFA500)
+        self.assertEqual(parse_color("rgb(255, 0, 10)"), 0xFF000A)
+
+        # Alpha is transparency
+        self.assertEqual(color.argb(1.0), 0x00FF8000)
+        self.assertEqual(color.argb(0.0), 0xFFFF8000)
+        self.assertEqual(color.argb(0.5), 0x80FF8000)
+
+        # Colors are stored in cached styles
+        self.assertEqual(pickle.loads(pickle.dumps(color)), color)
+        self.assertIsInstance(pickle.loads(pickle.dumps(color)), Color)
+
+    def test_same_as_name_heuristics(self):
+        """
+        Known properties are converted as guessed by their names
+        """
+        values = ["#FF0000", "none", "", "1.5", "wide", "1,2", "round"]
+        for name, converter in PROPERTIES.items():
+            guessed = get_converter("x-" + name)
+            for value in values:
+                try:
+                    expected = guessed(value)
+                except (ValueError, TypeError):
+                    # Not a color
+                    with self.assertRaises((ValueError, TypeError)):
+                        converter(value)
+                    continue
+                self.assertEqual(converter(value), expected, (name, value))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -26,6 +26,19 @@ class RuleTest(unittest.TestCase):
         self.assertCountEqual(Rule("node").type_matches, ('node', ))
         self.assertCountEqual(Rule("planet").type_matches, set())
 
+    def test_rule_matches_type(self):
+        self.assertTrue(Rule().matches_type("node"))
+        self.assertTrue(Rule("way").matches_type("line"))
+        self.assertFalse(Rule("area").matches_type("line"))
+        self.assertTrue(Rule("line").matches_type("area"))
+        self.assertFalse(Rule("planet").matches_type("planet"))
+        self.assertFalse(Rule().matches_type("relation"))
+
+    def test_rule_slots(self):
+        rule = Rule("line")
+        with self.assertRaises(AttributeError):
+            rule.isAnd = True
+
     def test_rule_with_conditions(self):
         rule = Rule()
         rule.conditions = [
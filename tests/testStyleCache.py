@@ -0,0 +1,119 @@
+import unittest
+import sys
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+# Add `src` directory to the import paths
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+import mapcss
+from mapcss import MapCSS, ParseUnitCache
+from mapcss.Properties import parse_color
+
+
+class StyleCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.cache_dir = str(Path(self.tmpdir.name) / 'cache')
+
+        self.main = Path(self.tmpdir.name) / 'main.mapcss'
+        self.main.write_text("""
+@import("colors.mapcss");
+
+line|z10-[highway=primary]
+{color: @primary; width: 2;}
+
+line|z12-[highway=primary]::shield
+{shield-font-size: 9; shield-text-color: #000000;}
+
+line|z15-[highway=secondary]
+{width: eval( num(tag("lanes")) * 2 );}
+""")
+        self.colors = Path(self.tmpdir.name) / 'colors.mapcss'
+        self.colors.write_text("""
+@primary: #FF8726;
+@unused: #000000;
+""")
+        self.static_tags = {"highway": True}
+
+    def parse(self, static_tags=None):
+        parser = MapCSS(0, 19)
+        parser.parse(filename=str(self.main), static_tags=static_tags or self.static_tags,
+                     clamp=False, cache_dir=self.cache_dir)
+        return parser
+
+    def test_cache_hit_skips_parsing(self):
+        parsed = self.parse()
+
+        with mock.patch.object(mapcss, 'parseDeclaration', side_effect=AssertionError("parsed again")):
+            cached = self.parse()
+
+        self.assertEqual(repr(cached.choosers), repr(parsed.choosers))
+        self.assertEqual(cached.variables, parsed.variables)
+        self.assertEqual(cached.unused_variables, {"unused"})
+        self.assertEqual(sorted(cached.choosers_by_type.keys()), sorted(parsed.choosers_by_type.keys()))
+        for choosers in cached.choosers_by_type.values():
+            for chooser in choosers:
+                self.assertIn(chooser, cached.choosers)
+
+        tags = {"highway": "secondary", "lanes": "3"}
+        rule, object_id = cached.choosers[2].testChains(tags)
+        self.assertEqual(object_id, "::default")
+        self.assertEqual(cached.choosers[2].updateStyles([], tags, 1, 1, None)[0]["width"], 6.0)
+
+    def test_changed_import_invalidates_cache(self):
+        self.parse()
+        self.colors.write_text("""
+@primary: #FFFFFF;
+@unused: #000000;
+""")
+
+        with mock.patch.object(mapcss, 'parseDeclaration', wraps=mapcss.parseDeclaration) as parse_declaration:
+            parser = self.parse()
+            self.assertTrue(parse_declaration.called)
+
+        self.assertEqual(parser.choosers[0].styles[0]["color"], parse_color("#ffffff"))
+
+    def test_changed_tags_invalidate_cache(self):
+        self.parse()
+
+        with mock.patch.object(mapcss, 'parseDeclaration', wraps=mapcss.parseDeclaration) as parse_declaration:
+            self.parse(static_tags={"highway": True, "lanes": False})
+            self.assertTrue(parse_declaration.called)
+
+
+    def test_unit_cache_shares_imports(self):
+        unit_cache = ParseUnitCache()
+        tmpdir = Path(self.tmpdir.name)
+        (tmpdir / 'rules.mapcss').write_text("""
+line|z10-[highway=primary]
+{color: @primary; width: 2;}
+""")
+        (tmpdir / 'light.mapcss').write_text("""
+@primary: #FFFFFF;
+@import("rules.mapcss");
+""")
+        (tmpdir / 'dark.mapcss').write_text("""
+@primary: #000000;
+@import("rules.mapcss");
+""")
+
+        def parse(name):
+            parser = MapCSS(0, 19)
+            parser.parse(filename=str(tmpdir / name), static_tags=self.static_tags, clamp=False,
+                         unit_cache=unit_cache)
+            return parser
+
+        light = parse('light.mapcss')
+        with mock.patch.object(mapcss, 'parseDeclaration', side_effect=AssertionError("parsed again")):
+            dark = parse('dark.mapcss')
+            light_again = parse('light.mapcss')
+
+        self.assertEqual(light.choosers[0].styles[0]["color"], parse_color("#ffffff"))
+        self.assertEqual(dark.choosers[0].styles[0]["color"], parse_color("#000000"))
+        self.assertEqual(repr(light_again.choosers), repr(light.choosers))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+import pickle
 import sys
 from pathlib import Path
 
@@ -8,8 +9,10 @@ from mapcss.Rule import Rule
 sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
 
 from mapcss import parseCondition, Condition
+from mapcss import Codegen
 from mapcss.Eval import Eval
-from mapcss.StyleChooser import StyleChooser, make_nice_style
+from mapcss.StyleChooser import StyleChooser, StyleCascade, make_nice_style
+from mapcss.Properties import parse_color
 
 
 class StyleChooserTest(unittest.TestCase):
@@ -38,6 +41,43 @@ class StyleChooserTest(unittest.TestCase):
 
         self.assertNotEqual(rule1, rule2)
 
+    def test_rules_chain_codegen(self):
+        sc = StyleChooser((0, 16))
+
+        sc.newObject()
+        sc.addCondition(parseCondition("highway=footway"))
+        sc.addCondition(parseCondition("population>=1000"))
+        sc.addCondition(parseCondition("!name"))
+        sc.addCondition(Condition("eq", ("::class", "::int_name")))
+
+        sc.newObject()
+        sc.addCondition(parseCondition("railway=~/^sub/"))
+        sc.addCondition(parseCondition("tunnel?"))
+
+        sc.newObject()
+
+        all_tags = [
+            {"highway": "footway", "population": "2000"},
+            {"highway": "footway", "population": "2000", "name": "A"},
+            {"highway": "footway", "population": "many"},
+            {"railway": "subway", "tunnel": "yes"},
+            {"railway": "Subway", "tunnel": "no"},
+            {},
+        ]
+        try:
+            Codegen.ENABLED = False
+            expected = [sc.testChains(tags) for tags in all_tags]
+        finally:
+            Codegen.ENABLED = True
+        self.assertEqual([sc.testChains(tags) for tags in all_tags], expected)
+        self.assertEqual(expected[0], (sc.ruleChains[0], "::int_name"))
+        self.assertEqual(expected[3], (sc.ruleChains[1], "::default"))
+        self.assertEqual(expected[5], (sc.ruleChains[2], "::default"))
+
+        sc = pickle.loads(pickle.dumps(sc))
+        self.assertIsNone(sc.compiled_chains)
+        self.assertEqual(sc.testChains(all_tags[3]), (sc.ruleChains[1], "::default"))
+
     def test_zoom(self):
         sc = StyleChooser((0, 16))
 
@@ -104,9 +144,9 @@ class StyleChooserTest(unittest.TestCase):
 
         expectedStyle = {
             "outline-color": "none",
-            "bg-color": (1.0, 0.0, 0.0),
-            "dash-color": (1.0, 1.0, 0.0),
-            "front-color": (0.0, 1.0, 1.0),
+            "bg-color": parse_color("#ff0000"),
+            "dash-color": parse_color("#ffff00"),
+            "front-color": parse_color("#00ffff"),
             "line-width": Eval("""eval(min(tag("line_width"), 10))"""),
             "outline-width": 2.5,
             "arrow-opacity": 0.5,
@@ -138,15 +178,15 @@ class StyleChooserTest(unittest.TestCase):
         self.assertEqual(sc.styles[0], {
             "width": 1.3,
             "opacity": 0.6,
-            "bg-color": (0.0, 0.0, 1.0)
+            "bg-color": parse_color("#0000ff")
         })
         self.assertEqual(sc.styles[1], {
-            "color": (1.0, 1.0, 1.0),
+            "color": parse_color("#ffffff"),
             "casing-width": 5.0
         })
 
     def test_update_styles(self):
-        styles = [{"primary_color": (1.0, 1.0, 1.0)}]
+        styles = [{"primary_color": parse_color("#ffffff")}]
 
         sc = StyleChooser((15, 19))
         sc.newObject()
@@ -163,7 +203,7 @@ class StyleChooserTest(unittest.TestCase):
         expected_new_styles = {
             "width": 1.3,
             "opacity": 0.6,
-            "bg-color": (1.0, 1.0, 1.0),
+            "bg-color": parse_color("#ffffff"),
             "text-offset": 10.0,
             "object-id": "::default"
         }
@@ -189,7 +229,7 @@ class StyleChooserTest(unittest.TestCase):
         new_styles = sc.updateStyles(styles, object_tags, 1.0, 1.0, False)
         expected_new_styles = {
             "width": 1.3,
-            "bg-color": (0.0, 0.0, 0.0),
+            "bg-color": parse_color("#000000"),
             "object-id": "::int_name" # Check that class from sc.ruleChains is added to the style
         }
 
@@ -250,6 +290,67 @@ class StyleChooserTest(unittest.TestCase):
         self.assertEqual(new_styles, expected_new_styles)
 
 
+    def test_update_styles_colors_with_evals(self):
+        sc = StyleChooser((15, 19))
+        sc.newObject()
+        sc.addStyles([{
+            "color": "#FF0000",
+            "casing-width": """eval( num(tag("lanes")) / 2 )"""
+        }])
+        new_styles = sc.updateStyles([], {"lanes": "3"}, 1.0, 1.0, False)
+        self.assertEqual(new_styles, [{"color": parse_color("#ff0000"), "casing-width": 1.5, "object-id": "::default"}])
+
+    def test_style_cascade(self):
+        cascade = StyleCascade()
+        default = {"width": 1.0}
+        cascade.add(default, "::default")
+        # Broadcast updates all subparts and is kept for new ones
+        cascade.add({"color": "red"}, "::*")
+        cascade.add({"width": 2.0}, "::casing")
+        cascade.add({"width": 3.0}, "::default")
+        cascade.add({"color": "blue"}, "::*")
+        self.assertEqual(cascade.get_styles(), [
+            {"width": 3.0, "color": "blue", "object-id": "::default"},
+            {"color": "blue", "object-id": "::*"},
+            {"width": 2.0, "color": "blue", "object-id": "::casing"},
+        ])
+        self.assertEqual(cascade.by_id["::casing"], 2)
+        # Added styles are copied when they are overridden
+        self.assertEqual(default, {"width": 1.0})
+
+        cascade = StyleCascade()
+        cascade.add(default, "::default")
+        self.assertIs(cascade.styles[0], default)
+        style = cascade.own(0)
+        self.assertEqual(style, {"width": 1.0, "object-id": "::default"})
+        self.assertIs(cascade.own(0), style)
+        self.assertEqual(default, {"width": 1.0})
+
+        # Values of the last style in the list win
+        cascade.add({"color": "red"}, "::*")
+        cascade.add({"width": 2.0}, "::casing")
+        self.assertEqual(cascade.get_props().get("width"), 2.0)
+        self.assertEqual(cascade.props.get("object-id"), "::casing")
+        self.assertEqual(cascade.props.get("opacity", ""), "")
+        cascade.add({"width": 4.0}, "::default")
+        self.assertEqual(cascade.props.get("width"), 2.0)
+        cascade.add({"width": 5.0}, "::casing")
+        self.assertEqual(cascade.props.get("width"), 5.0)
+
+        # Colors are seen as hex
+        cascade.add({"fill-color": parse_color("#ff0000")}, "::default")
+        self.assertEqual(cascade.props.get("fill-color"), "#ff0000")
+        cascade.add({"fill-color": parse_color("#0000ff")}, "::*")
+        self.assertEqual(cascade.props.get("fill-color"), "#0000ff")
+
+        # Given list is updated in place
+        styles = [{"width": 1.0, "object-id": "::default"}]
+        cascade = StyleCascade(styles)
+        cascade.add({"width": 2.0}, "::casing")
+        cascade.add({"width": 3.0}, "::default")
+        self.assertIs(cascade.get_styles(), styles)
+        self.assertEqual(styles, [{"width": 3.0, "object-id": "::default"}, {"width": 2.0, "object-id": "::casing"}])
+
     def test_update_styles_by_class_all(self):
         # Predefined styles
         styles = [{ # This is applied to StyleChooser styles
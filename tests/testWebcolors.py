@@ -0,0 +1,46 @@
+import unittest
+import sys
+from pathlib import Path
+
+# Add `src` directory to the import paths
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src'))
+
+from mapcss.webcolors import webcolors
+
+
+class WebcolorsTest(unittest.TestCase):
+    def test_whatever_conversions(self):
+        self.assertEqual(webcolors.whatever_to_rgb(" DarkSlateGray "), (47, 79, 79))
+        self.assertEqual(webcolors.whatever_to_rgb("#F00"), (255, 0, 0))
+        self.assertEqual(webcolors.whatever_to_rgb("rgb(10, 20, 30)"), (10.0, 20.0, 30.0))
+        self.assertEqual(webcolors.whatever_to_hex("orange"), "#FFA500")
+        self.assertEqual(webcolors.whatever_to_hex((1.0, 0.0, 0.0)), "#FF0000")
+        self.assertEqual(webcolors.whatever_to_cairo("#ff0000"), (1.0, 0.0, 0.0))
+        self.assertEqual(webcolors.cairo_to_hex((0.0, 0.0, 1.0)), "#0000ff")
+
+    def test_conversions_are_cached(self):
+        webcolors.whatever_to_hex.cache_clear()
+        webcolors.whatever_to_hex("#123456")
+        webcolors.whatever_to_hex("#123456")
+        info = webcolors.whatever_to_hex.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+        self.assertEqual(info.maxsize, webcolors.COLOR_CACHE_SIZE)
+
+    def test_css3_names_to_rgb(self):
+        self.assertEqual(len(webcolors.css3_names_to_rgb), len(webcolors.css3_names_to_hex))
+        for name, rgb in webcolors.css3_names_to_rgb.items():
+            self.assertEqual(rgb, webcolors.hex_to_rgb(webcolors.css3_names_to_hex[name]))
+
+    def test_lazy_hex_to_names(self):
+        self.assertEqual(webcolors.css3_hex_to_names["#000080"], "navy")
+        self.assertIs(webcolors.css3_hex_to_names, webcolors.css3_hex_to_names)
+        self.assertIs(webcolors.css2_hex_to_names, webcolors.html4_hex_to_names)
+        self.assertEqual(webcolors.css21_hex_to_names["#ffa500"], "orange")
+        self.assertNotIn("#ffa500", webcolors.html4_hex_to_names)
+        self.assertEqual(webcolors.hex_to_name("#8B4513"), "saddlebrown")
+        with self.assertRaises(AttributeError):
+            webcolors.css4_hex_to_names
+
+
+if __name__ == '__main__':
+    unittest.main()